@@ -13,7 +13,7 @@ import warnings; warnings.filterwarnings(action='ignore', category=DeprecationWa
 import threading
 import time
 import os
-import socket, urlparse, urllib, urllib2
+import socket, urlparse, urllib, urllib2, httplib
 import oauth
 import htmlentitydefs
 import sgmllib
@@ -22,18 +22,20 @@ import xml.dom.minidom
 import json
 import StringIO
 import bisect
+import hashlib
+import zlib
 
 try:
     # Import persistent Cache.
     # If this module is used separately, a dict is used (i.e. for this Python session only).
-    from cache import Cache, cache
+    from cache import Cache, LRUCache, MemoryCache, SQLiteCache, cache
 except:
     cache = {}
 
 try:
-    from imap import Mail, MailFolder, Message, GMAIL
+    from imap import Mail, MailFolder, MailStore, Message, GMAIL
     from imap import MailError, MailServiceError, MailLoginError, MailNotLoggedIn
-    from imap import FROM, SUBJECT, DATE, BODY, ATTACHMENTS
+    from imap import FROM, SUBJECT, DATE, BODY, ATTACHMENTS, UID
 except:
     pass
     
@@ -83,37 +85,38 @@ class AsynchronousRequest:
             For example, this is useful for running live web requests while keeping an animation running.
             For good reasons, there is no way to interrupt a background process (i.e. Python thread).
             You are responsible for ensuring that the given function doesn't hang.
+            The function runs on one of the threads of the shared executor (see WorkerPool),
+            so many requests don't start as many threads.
         """
-        self._response = None # The return value of the given function.
-        self._error    = None # The exception (if any) raised by the function.
-        self._time     = time.time()
         self._function = function
-        self._thread   = threading.Thread(target=self._fetch, args=(function,)+args, kwargs=kwargs)
-        self._thread.start()
-        
-    def _fetch(self, function, *args, **kwargs):
-        try: 
-            self._response = function(*args, **kwargs)
-        except Exception, e:
-            self._error = e
+        self._job = executor.submit(function, *args, **kwargs)
 
-    def now(self):
+    def now(self, timeout=None):
         """ Waits for the function to finish and yields its return value.
         """
-        self._thread.join(); return self._response
+        return self._job.now(timeout)
+
+    def result(self, timeout=None):
+        return self._job.result(timeout)
+
+    def cancel(self):
+        return self._job.cancel()
+
+    def add_done_callback(self, function):
+        self._job.add_done_callback(lambda job: function(self))
 
     @property
     def elapsed(self):
-        return time.time() - self._time
+        return self._job.elapsed
     @property
     def done(self):
-        return not self._thread.isAlive()
+        return self._job.done
     @property
     def value(self):
-        return self._response
+        return self._job.value
     @property
     def error(self):
-        return self._error
+        return self._job.error
         
     def __repr__(self):
         return "AsynchronousRequest(function='%s')" % self._function.__name__
@@ -122,6 +125,230 @@ def asynchronous(function, *args, **kwargs):
     return AsynchronousRequest(function, *args, **kwargs)
 send = asynchronous
 
+#--- WORKER POOL -------------------------------------------------------------------------------------
+# A WorkerPool runs jobs on a fixed number of background threads that are shared,
+# so that several objects can queue requests without blocking each other (or the caller).
+# WorkerPool.submit() returns a Job, which can be waited for (Job.result()), cancelled while queued,
+# or given callbacks that are called when it is done.
+
+import Queue
+
+class JobTimeout(Exception):
+    pass # Job is not done within the given timeout.
+class JobCancelled(Exception):
+    pass # Job was cancelled before it started.
+
+class Job:
+
+    def __init__(self, function, *args, **kwargs):
+        """ A function call queued in a WorkerPool.
+            Job.done is True once the function has returned (or raised an error, or was cancelled).
+            Job.value contains the function's return value once done.
+            Job.error contains the Exception raised by an erronous function.
+        """
+        self._response  = None
+        self._error     = None
+        self._time      = time.time()
+        self._function  = function
+        self._args      = args
+        self._kwargs    = kwargs
+        self._event     = threading.Event()
+        self._cancelled = False
+        self._running   = False
+        self._callbacks = []
+        self._lock      = threading.Lock()
+        self.key        = None
+
+    def _run(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._running = True
+        try:
+            self._response = self._function(*self._args, **self._kwargs)
+        except Exception, e:
+            self._error = e
+        self._done()
+
+    def _done(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for f in callbacks:
+            f(self)
+
+    def cancel(self):
+        """ Cancels the job. Returns False if the job is already running or done.
+            A running job can't be interrupted, but it can check Job.cancelled
+            (e.g., to stop sending results for a query that is no longer needed).
+        """
+        with self._lock:
+            if self._event.isSet():
+                return False
+            self._cancelled = True
+            if self._running:
+                return False
+        self._done()
+        return True
+
+    def add_done_callback(self, function):
+        """ Calls function(job) when the job is done (or cancelled),
+            or immediately if it is already done.
+        """
+        with self._lock:
+            if not self._event.isSet():
+                self._callbacks.append(function); return
+        function(self)
+
+    def now(self, timeout=None):
+        """ Waits for the job to finish and yields its return value.
+        """
+        self._event.wait(timeout); return self._response
+
+    def result(self, timeout=None):
+        """ Waits for the job to finish and returns its return value.
+            Raises the function's exception if it failed, JobTimeout if it is not done in time,
+            or JobCancelled if it was cancelled before it started.
+        """
+        if not self._event.wait(timeout):
+            raise JobTimeout
+        if self._cancelled and not self._running:
+            raise JobCancelled
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+    @property
+    def elapsed(self):
+        return time.time() - self._time
+    @property
+    def done(self):
+        return self._event.isSet()
+    @property
+    def running(self):
+        return self._running and not self._event.isSet()
+    @property
+    def cancelled(self):
+        return self._cancelled
+    @property
+    def value(self):
+        return self._response
+    @property
+    def error(self):
+        return self._error
+
+    def __repr__(self):
+        return "Job(function='%s')" % self._function.__name__
+
+class WorkerPool:
+
+    def __init__(self, threads=4):
+        """ A fixed number of background threads that execute queued jobs in order.
+            Threads are started when the first job is submitted.
+            Jobs submitted with the same key are coalesced: as long as a job is pending,
+            WorkerPool.submit() with an identical key returns the pending job.
+        """
+        self.threads  = threads
+        self._queue   = Queue.Queue()
+        self._workers = []
+        self._pending = {} # key => Job
+        self._lock    = threading.Lock()
+
+    def _start(self):
+        while len(self._workers) < self.threads:
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                job._run()
+            finally:
+                self._release(job)
+
+    def _release(self, job):
+        with self._lock:
+            if job.key is not None and self._pending.get(job.key) is job:
+                del self._pending[job.key]
+
+    def submit(self, function, *args, **kwargs):
+        """ Queues the function call and returns a Job.
+            An optional key=[hashable] keyword argument is used to coalesce duplicate jobs.
+        """
+        key = kwargs.pop("key", None)
+        with self._lock:
+            if key is not None and key in self._pending and not self._pending[key].cancelled:
+                return self._pending[key]
+            job = Job(function, *args, **kwargs)
+            job.key = key
+            if key is not None:
+                self._pending[key] = job
+            self._start()
+        self._queue.put(job)
+        return job
+
+    def cancel(self, key):
+        """ Cancels the pending job with the given key (if any).
+        """
+        with self._lock:
+            job = self._pending.pop(key, None)
+        return job is not None and job.cancel()
+
+    def map(self, function, *iterables, **kwargs):
+        """ Yields function(*args) for the items in the given lists, in order.
+            The calls are executed concurrently; an optional timeout=[seconds] applies to all results.
+        """
+        timeout = kwargs.get("timeout")
+        jobs = [self.submit(function, *args) for args in zip(*iterables)]
+        t = time.time()
+        try:
+            for job in jobs:
+                yield job.result(None if timeout is None else max(0, timeout - (time.time() - t)))
+        finally:
+            # Jobs that are still queued are not needed anymore.
+            for job in jobs:
+                job.cancel()
+
+    def close(self):
+        """ Stops the threads once the queued jobs are done.
+        """
+        with self._lock:
+            for t in self._workers:
+                self._queue.put(None)
+            self._workers = []
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def __repr__(self):
+        return "WorkerPool(threads=%s)" % self.threads
+
+def as_completed(jobs, timeout=None):
+    """ Yields the given jobs as soon as each is done (or cancelled).
+        Raises JobTimeout if not all jobs are done within the given amount of seconds.
+    """
+    jobs = list(jobs)
+    done = Queue.Queue()
+    for job in jobs:
+        job.add_done_callback(done.put)
+    t = time.time()
+    for i in range(len(jobs)):
+        try:
+            yield done.get(True, None if timeout is None else max(0, timeout - (time.time() - t)))
+        except Queue.Empty:
+            raise JobTimeout
+
+# The shared pool used by Qweb objects for background searches.
+workers = WorkerPool(threads=4)
+
+# The shared pool used by asynchronous().
+executor = WorkerPool(threads=8)
+
 #### URL #############################################################################################
 
 # User agent and referrer.
@@ -179,6 +406,8 @@ class URLError(Exception):
     pass # URL contains errors (e.g. a missing t in htp://).
 class URLTimeout(URLError):
     pass # URL takes to long to load.
+class URLTooLarge(URLError):
+    pass # URL content exceeds the given maximum size.
 class HTTPError(URLError):
     pass # URL causes an error on the contacted server.
 class HTTP301Redirect(HTTPError):
@@ -187,6 +416,8 @@ class HTTP301Redirect(HTTPError):
          # or taking other measures to discern a browser from a script.
          # For specific purposes you should build your own urllib2.HTTPRedirectHandler
          # and pass it to urllib2.build_opener() in URL.open()
+class HTTP304NotModified(HTTPError):
+    pass # URL has not changed since the given If-None-Match or If-Modified-Since header.
 class HTTP400BadRequest(HTTPError):
     pass # URL contains an invalid request.
 class HTTP401Authentication(HTTPError):
@@ -199,7 +430,329 @@ class HTTP420Error(HTTPError):
     pass # Used by Twitter for rate limiting.
 class HTTP500InternalServerError(HTTPError):
     pass # Generic server error.
+
+#--- CONNECTION POOL ---------------------------------------------------------------------------------
+# By default, urllib2 closes the connection after each request,
+# so each request to a web service opens a new TCP connection (and does a new SSL handshake).
+# The KeepAliveHandler keeps connections open after the response has been read,
+# and reuses them for the next request to the same server.
+
+POOL_SIZE    = 4  # Maximum number of idle connections per (scheme, host, port).
+IDLE_TIMEOUT = 30 # Idle connections are closed after 30 seconds.
+
+class ConnectionPool:
+
+    def __init__(self, size=POOL_SIZE, timeout=IDLE_TIMEOUT):
+        """ A thread-safe pool of idle HTTP connections, by (scheme, host, port).
+        """
+        self.size     = size
+        self.timeout  = timeout
+        self._idle    = {} # (scheme, host, port) => [(connection, time), ...]
+        self._lock    = threading.Lock()
+
+    def get(self, key):
+        """ Returns an idle connection for the given (scheme, host, port), or None.
+        """
+        with self._lock:
+            a = self._idle.get(key, [])
+            while a:
+                connection, t = a.pop()
+                if time.time() - t < self.timeout:
+                    return connection
+                connection.close()
+
+    def put(self, key, connection):
+        """ Returns the connection to the pool (or closes it if the pool is full).
+        """
+        with self._lock:
+            a = self._idle.setdefault(key, [])
+            if len(a) < self.size:
+                a.append((connection, time.time())); return
+        connection.close()
+
+    def clear(self):
+        with self._lock:
+            for a in self._idle.values():
+                for connection, t in a:
+                    connection.close()
+            self._idle = {}
+
+    def __len__(self):
+        return sum(len(a) for a in self._idle.values())
+
+# The shared pool of connections.
+connections = ConnectionPool()
+
+class _PooledResponse:
+
+    def __init__(self, response, connection, key, pool):
+        # Wraps a httplib.HTTPResponse.
+        # The connection is returned to the pool when the response has been read completely.
+        self._response   = response
+        self._connection = connection
+        self._key        = key
+        self._pool       = pool
+
+    def _release(self):
+        if self._connection is not None and self._response.isclosed():
+            if not self._response.will_close:
+                self._pool.put(self._key, self._connection)
+            else:
+                self._connection.close()
+            self._connection = None
+
+    def recv(self, n):
+        data = self._response.read(n)
+        self._release()
+        return data
+
+    def close(self):
+        # A connection with unread data can't be reused.
+        self._release()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+
+    def __init__(self, pool=None):
+        """ A urllib2 handler for http:// and https:// URLs that uses persistent connections.
+        """
+        urllib2.HTTPHandler.__init__(self)
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool or connections
+
+    def http_open(self, request):
+        return self._open(httplib.HTTPConnection, "http", request)
+
+    def https_open(self, request):
+        return self._open(httplib.HTTPSConnection, "https", request)
+
+    def _open(self, http_class, scheme, request):
+        host = request.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+        headers = dict(request.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in request.headers.items() if k not in headers))
+        headers = dict((k.title(), v) for k, v in headers.items())
+        headers["Connection"] = "keep-alive"
+        tunnel = {}
+        if request._tunnel_host and "Proxy-Authorization" in headers:
+            # Through a CONNECT tunnel, proxy credentials go to the proxy, not to the origin server.
+            # Without a tunnel (plain HTTP through a proxy), the request itself goes to the proxy.
+            tunnel["Proxy-Authorization"] = headers.pop("Proxy-Authorization")
+        key = (scheme, host, request._tunnel_host)
+        # An idle connection may have been closed by the server in the meantime,
+        # in which case the request is sent again on a new connection.
+        for connection in (self.pool.get(key), None):
+            reused = connection is not None
+            if connection is None:
+                connection = http_class(host, timeout=request.timeout)
+                if request._tunnel_host:
+                    connection.set_tunnel(request._tunnel_host, headers=tunnel)
+            elif connection.sock is not None:
+                connection.sock.settimeout(request.timeout)
+            try:
+                connection.request(request.get_method(), request.get_selector(), request.data, headers)
+                response = connection.getresponse(buffering=True)
+                break
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if not reused:
+                    raise urllib2.URLError(e)
+        fp = socket._fileobject(_PooledResponse(response, connection, key, self.pool), close=True)
+        r = urllib.addinfourl(fp, response.msg, request.get_full_url())
+        r.code = response.status
+        r.msg  = response.reason
+        return r
+
+    http_request  = urllib2.AbstractHTTPHandler.do_request_
+    https_request = urllib2.AbstractHTTPHandler.do_request_
+
+def build_opener(proxy=None, pool=None):
+    """ Returns a urllib2 opener that reuses connections from the given ConnectionPool,
+        optionally through the given proxy (see proxy()).
+    """
+    handlers = [KeepAliveHandler(pool)]
+    if proxy:
+        handlers.append(urllib2.ProxyHandler({proxy[1]: proxy[0]}))
+    return urllib2.build_opener(*handlers)
+
+_openers = {}
+_openers_lock = threading.Lock()
+
+def _opener(proxy=None):
+    # Returns the shared opener for the given proxy.
+    with _openers_lock:
+        if proxy not in _openers:
+            _openers[proxy] = build_opener(proxy)
+        return _openers[proxy]
+
+#--- CONTENT ENCODING --------------------------------------------------------------------------------
+# URL.open() asks the server for gzip or deflate compressed content (Accept-Encoding), 
+# and decompresses it while it is read.
+# Functions in the transfer list are called with (url, compressed bytes, bytes) 
+# when a response has been read, e.g., to log how much bandwidth is saved.
+
+ACCEPT_ENCODING = "gzip, deflate"
+
+transfer = []
+
+class _Response:
+
+    def __init__(self, response):
+        """ Wraps a urllib2 response, decompresses gzip and deflate content and counts the bytes read.
+        """
+        self._response = response
+        self._encoding = response.info().get("Content-Encoding", "").lower().strip()
+        self._zlib     = None
+        self._buffer   = ""
+        self._eof      = False
+        self.compressed = 0 # Number of bytes received.
+        self.bytes      = 0 # Number of bytes after decompression.
+        self.code = getattr(response, "code", None)
+        self.msg  = getattr(response, "msg", None)
+        if self._encoding in ("gzip", "x-gzip", "deflate"):
+            # The headers describe the compressed content.
+            for k in ("Content-Encoding", "Content-Length"):
+                if k in response.info():
+                    del response.info()[k]
+            self._zlib = zlib.decompressobj(self._encoding == "deflate" and zlib.MAX_WBITS or 16 + zlib.MAX_WBITS)
+
+    def _decode(self, data):
+        if self._zlib is None:
+            return data
+        try:
+            return self._zlib.decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib header.
+            if self._encoding == "deflate" and self.compressed == len(data):
+                self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self._zlib.decompress(data)
+            raise
+
+    def _fill(self, n=None):
+        # Reads until the buffer contains n bytes (or all bytes, if n is None).
+        while not self._eof and (n is None or len(self._buffer) < n):
+            data = self._response.read(n is None and -1 or max(n, CHUNK_SIZE))
+            if data:
+                self.compressed += len(data)
+                data = self._decode(data)
+            else:
+                self._eof = True
+                data = self._zlib is not None and self._zlib.flush() or ""
+            self.bytes += len(data)
+            self._buffer += data
+            if self._eof:
+                for f in transfer:
+                    f(self.geturl(), self.compressed, self.bytes)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            self._fill()
+            data, self._buffer = self._buffer, ""
+        else:
+            self._fill(n)
+            data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def readline(self):
+        while "\n" not in self._buffer and not self._eof:
+            self._fill(len(self._buffer) + 1)
+        i = self._buffer.find("\n") + 1 or len(self._buffer)
+        return self.read(i)
+
+    def readlines(self):
+        return list(iter(self.readline, ""))
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def info(self):
+        return self._response.info()
+
+    def geturl(self):
+        return self._response.geturl()
+
+    def getcode(self):
+        return self.code
+
+    def fileno(self):
+        return self._response.fileno()
+
+    def close(self):
+        self._response.close()
     
+#--- RATE LIMITER ------------------------------------------------------------------------------------
+# URL.download(throttle) limits the number of requests to a host to one per throttle seconds.
+# The limit is shared by all threads (and SearchEngine instances) requesting the same host.
+# Each host has a token bucket that refills at the given rate, up to a number of tokens (burst).
+# A request takes a token, and only waits if the bucket is empty.
+
+BURST = 2
+
+# Rate limits for specific hosts: host => (requests per second, burst).
+# These take precedence over the throttle passed to URL.download().
+# Flickr allows 3600 API calls per hour per key: FlickrResult.url makes one call per photo,
+# so the burst lets a page of results be resolved concurrently.
+RATES = {
+    "api.flickr.com": (1.0, 8),
+}
+
+class TokenBucket:
+
+    def __init__(self, rate=1.0, burst=BURST):
+        """ A thread-safe token bucket with the given rate (tokens per second) and capacity.
+        """
+        self.rate   = rate
+        self.burst  = burst
+        self._tokens = float(burst)
+        self._time   = time.time()
+        self._lock   = threading.Lock()
+
+    def take(self):
+        """ Takes a token and returns the number of seconds to wait before using it.
+        """
+        with self._lock:
+            t = time.time()
+            self._tokens = min(self.burst, self._tokens + (t - self._time) * self.rate)
+            self._time = t
+            # Tokens are reserved by going below zero, so concurrent callers queue up in order.
+            self._tokens -= 1
+            return self._tokens < 0 and -self._tokens / self.rate or 0
+
+class RateLimiter:
+
+    def __init__(self, rates=RATES, burst=BURST):
+        """ A token bucket for each host.
+        """
+        self.rates    = rates
+        self.burst    = burst
+        self._buckets = {}
+        self._lock    = threading.Lock()
+
+    def wait(self, host, throttle=0):
+        """ Blocks until a request to the given host is allowed.
+            Without a rate in RateLimiter.rates, the rate is one request per throttle seconds.
+        """
+        rate, burst = self.rates.get(host, (throttle and 1.0 / throttle or None, self.burst))
+        if not rate:
+            return
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(rate, burst)
+            b = self._buckets[host]
+            b.rate, b.burst = rate, burst
+        t = b.take()
+        if t > 0:
+            time.sleep(t)
+
+# The rate limiter shared by all URL.download() calls.
+limiter = RateLimiter()
+
+# Size of the chunks read by URL.save().
+CHUNK_SIZE = 64 * 1024
+
 class URL:
     
     def __init__(self, string=u"", method=GET, query={}):
@@ -295,10 +848,12 @@ class URL:
         if k in self.parts    : self.__dict__["_parts"][k] = u(v); return
         raise AttributeError, "'URL' object has no attribute '%s'" % k
         
-    def open(self, timeout=10, proxy=None, user_agent=USER_AGENT, referrer=REFERRER):
+    def open(self, timeout=10, proxy=None, user_agent=USER_AGENT, referrer=REFERRER, headers={}, opener=None):
         """ Returns a connection to the url from which data can be retrieved with connection.read().
             When the timeout amount of seconds is exceeded, raises a URLTimeout.
             When an error occurs, raises a URLError (e.g. HTTP404NotFound).
+            Additional request headers can be given as a dictionary.
+            Connections are kept open and reused, see build_opener().
         """
         url = self.string
         # Use basic urllib.urlopen() instead of urllib2.urlopen() for local files.
@@ -307,15 +862,16 @@ class URL:
         # Get the query string as a separate parameter if method=POST.          
         post = self.method == POST and urllib.urlencode(bytestring(self.query)) or None
         socket.setdefaulttimeout(timeout)
-        if proxy:
-            proxy = urllib2.ProxyHandler({proxy[1]: proxy[0]})
-            proxy = urllib2.build_opener(proxy, urllib2.HTTPHandler)
-            urllib2.install_opener(proxy)
+        if proxy or opener is None:
+            opener = _opener(proxy)
         try:
-            request = urllib2.Request(url, post, {"User-Agent": user_agent, "Referer": referrer})
-            return urllib2.urlopen(request)
+            h = {"User-Agent": user_agent, "Referer": referrer, "Accept-Encoding": ACCEPT_ENCODING}
+            h.update(headers)
+            request = urllib2.Request(url, post, h)
+            return _Response(opener.open(request, timeout=timeout))
         except urllib2.HTTPError, e:
             if e.code == 301: raise HTTP301Redirect
+            if e.code == 304: raise HTTP304NotModified
             if e.code == 400: raise HTTP400BadRequest
             if e.code == 401: raise HTTP401Authentication
             if e.code == 403: raise HTTP403Forbidden
@@ -331,9 +887,14 @@ class URL:
         except ValueError:
             raise URLError
             
-    def download(self, timeout=10, cached=True, throttle=0, proxy=None, user_agent=USER_AGENT, referrer=REFERRER):
+    def download(self, timeout=10, cached=True, throttle=0, proxy=None, user_agent=USER_AGENT, referrer=REFERRER, ttl=None, grace=None, opener=None):
         """ Downloads the content at the given URL (by default it will be cached locally).
             The content is returned as a unicode string.
+            With a throttle (in seconds), requests to the same host are limited to one per throttle seconds
+            (after a burst of BURST requests), see RateLimiter.
+            With a ttl (in seconds), cached content older than ttl is downloaded again.
+            Cached content older than ttl but younger than ttl+grace (by default, 2*ttl)
+            is returned immediately, while it is downloaded again in the background.
         """
         # Filter OAuth parameters from cache id (they will be unique for each request).
         if self._parts is None and self.method == GET and "oauth_" not in self._string:
@@ -342,17 +903,87 @@ class URL:
             id = repr(self.parts)
             id = re.sub("u{0,1}'oauth_.*?': u{0,1}'.*?', ", "", id)
         if cached and id in cache:
-            return cache[id]
-        t = time.time()
+            # Without the cache module, cache is a dict without timestamps: entries count as fresh.
+            if ttl is None or getattr(cache, "timestamp", None) is None:
+                return cache[id]
+            age = time.time() - cache.timestamp(id)
+            if age <= ttl:
+                return cache[id]
+            if age <= ttl + (ttl if grace is None else grace):
+                workers.submit(self._download, id, timeout, proxy, user_agent, referrer, opener, throttle, key=("download", id))
+                return cache[id]
+        return self._download(cached and id or None, timeout, proxy, user_agent, referrer, opener, throttle)
+
+    def _download(self, id, timeout=10, proxy=None, user_agent=USER_AGENT, referrer=REFERRER, opener=None, throttle=0):
         # Open a connection with the given settings, read it and (by default) cache the data.
-        data = self.open(timeout, proxy, user_agent, referrer).read()
+        limiter.wait(self.domain, throttle)
+        data = self.open(timeout, proxy, user_agent, referrer, opener=opener).read()
         data = u(data)
-        if cached:
+        if id is not None:
             cache[id] = data
-        if throttle:
-            time.sleep(max(throttle-(time.time()-t), 0))
         return data
-    
+
+    def save(self, file, chunk=CHUNK_SIZE, progress=None, limit=None, hash=None, cached=False, timeout=10, **kwargs):
+        """ Copies the content at the given URL to the given file (path or file-like object),
+            in chunks of the given size, so that large (binary) files don't need to fit in memory.
+            Returns the number of bytes written.
+            - progress: a function(bytes, total) called after each chunk (total can be None),
+            - limit   : the maximum number of bytes, raises URLTooLarge when exceeded,
+            - hash    : a hashlib object (e.g., hashlib.md5()) that is updated with each chunk,
+            - cached  : if True, the content is also stored as a file in the cache folder,
+                        and the cache keeps a reference to this file (see Cache.blob()).
+                        With an LRUCache, files larger than a fraction of the cache size are not kept.
+        """
+        id, blob = "blob:%s" % self.string, None
+        if cached and id in cache and os.path.exists(cache[id]):
+            source, total = open(cache[id], "rb"), os.path.getsize(cache[id])
+        else:
+            source = self.open(timeout, **kwargs)
+            total = source.info().get("Content-Length")
+            total = total and int(total) or None
+            if cached and getattr(cache, "blob", None) is not None:
+                blob = cache.blob(id)
+        if limit is not None and total > limit:
+            source.close()
+            raise URLTooLarge
+        # Files are written to a temporary file that replaces the file when done,
+        # so an interrupted download doesn't leave an incomplete file.
+        f = isinstance(file, basestring) and open(file + ".part", "wb") or file
+        b = blob and open(blob + ".part", "wb")
+        n = 0
+        try:
+            while True:
+                data = source.read(chunk)
+                if not data:
+                    break
+                n += len(data)
+                if limit is not None and n > limit:
+                    raise URLTooLarge
+                if hash is not None:
+                    hash.update(data)
+                if b:
+                    b.write(data)
+                f.write(data)
+                if progress is not None:
+                    progress(n, total)
+        except:
+            for x, path in ((f, file), (b, blob)):
+                if x and x is not file:
+                    x.close()
+                    os.remove(path + ".part")
+            raise
+        finally:
+            source.close()
+        for x, path in ((f, file), (b, blob)):
+            if x and x is not file:
+                x.close()
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(path + ".part", path)
+        if b:
+            cache[id] = blob
+        return n
+
     def read(self, *args):
         return self.open().read(*args)
             
@@ -813,13 +1444,34 @@ class SearchEngine:
             Inherited by: Google, Yahoo, Bing, Twitter, Wikipedia, Flickr.
         """
         self.license  = license
-        self.throttle = throttle    # Amount of sleep time after executing a query.
+        self.throttle = throttle    # Minimum delay between queries to the service (see RateLimiter).
+        self.ttl      = None        # Amount of seconds a cached query stays valid (None = forever).
+        self.opener   = build_opener() # Keeps connections to the service open between queries.
         self.language = language    # Result.language restriction (e.g., "en").
         self.format   = lambda x: x # Formatter applied to each attribute of each Result.
     
     def search(self, query, type=SEARCH, start=1, count=10, sort=RELEVANCY, size=None, cached=True, **kwargs):
         return Results(source=None, query=query, type=type)
 
+    def search_many(self, queries, threads=4, **kwargs):
+        """ Yields (query, Results)-tuples for the given list of queries, as soon as each search is done.
+            The searches run concurrently on the given number of threads 
+            (the rate of requests is still limited by SearchEngine.throttle, see RateLimiter).
+            For a search that fails, (query, Exception) is yielded instead.
+            Optional parameters are passed to SearchEngine.search().
+        """
+        queries = list(queries)
+        pool = WorkerPool(threads=min(threads, len(queries) or 1))
+        jobs = dict((pool.submit(self.search, q, **kwargs), q) for q in queries)
+        pool.close()
+        try:
+            for job in as_completed(jobs.keys()):
+                yield (jobs[job], job.error or job.value)
+        finally:
+            # Searches that are still queued are not needed anymore.
+            for job in jobs:
+                job.cancel()
+
 class SearchEngineError(HTTPError):
     pass
 class SearchEngineTypeError(SearchEngineError):
@@ -865,6 +1517,8 @@ class Google(SearchEngine):
         if self.language is not None:
             url.query["lr"] = "lang_" + self.language
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = url.download(cached=cached, **kwargs)
         data = json.loads(data)
         if data.get("error", {}).get("code") == 403:
@@ -897,6 +1551,8 @@ class Google(SearchEngine):
         })
         kwargs.setdefault("cached", False)
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = url.download(**kwargs)
         data = json.loads(data)
         data = (data.get("responseData") or {}).get("translatedText", "")
@@ -912,6 +1568,8 @@ class Google(SearchEngine):
         })
         kwargs.setdefault("cached", False)
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = url.download(**kwargs)
         data = json.loads(data)
         data = data.get("responseData") or {}
@@ -962,6 +1620,8 @@ class Yahoo(SearchEngine):
         query["oauth_signature"] = oauth.sign(url, query, method=GET, secret=self.license[1])
         url = URL(url, method=GET, query=query)
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         try: 
             data = url.download(cached=cached, **kwargs)
         except HTTP401Authentication:
@@ -1025,6 +1685,8 @@ class Bing(SearchEngine):
                             LARGE : "Size:Large" }.get(size,"")
         })
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = url.download(cached=cached, **kwargs)
         data = json.loads(data)
         data = data.get("SearchResponse", {}).get(s.capitalize(), {})
@@ -1053,6 +1715,7 @@ class Twitter(SearchEngine):
     
     def __init__(self, license=None, throttle=0.5, language=None):
         SearchEngine.__init__(self, license or TWITTER_LICENSE, throttle, language)
+        self.ttl = 60
 
     def search(self, query, type=SEARCH, start=1, count=10, sort=RELEVANCY, size=None, cached=False, **kwargs):
         """ Returns a list of results from Twitter for the given query.
@@ -1076,6 +1739,8 @@ class Twitter(SearchEngine):
         if not query or count < 1 or start > 1500/count: 
             return Results(TWITTER, query, type)
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         try: 
             data = URL(url).download(cached=cached, **kwargs)
         except HTTP420Error:
@@ -1128,6 +1793,7 @@ class Wikipedia(SearchEngine):
     
     def __init__(self, license=None, throttle=5.0, language="en"):
         SearchEngine.__init__(self, license or WIKIPEDIA_LICENSE, throttle, language)
+        self.ttl = 7 * 24 * 60 * 60
 
     def search(self, query, type=SEARCH, start=1, count=1, sort=RELEVANCY, size=None, cached=True, **kwargs):
         """ Returns a WikipediaArticle for the given query.
@@ -1144,6 +1810,8 @@ class Wikipedia(SearchEngine):
         })
         kwargs.setdefault("timeout", 30) # Parsing the article can take some time.
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = url.download(cached=cached, **kwargs)
         data = json.loads(data)
         data = data.get("parse", {})
@@ -1227,8 +1895,7 @@ class WikipediaArticle:
             open(filename+extension(media),"w").write(data)
         """
         url = "http://%s.wikipedia.org/wiki/File:%s" % (self.__dict__.get("language", "en"), media)
-        if url not in cache:
-            time.sleep(1)
+        kwargs.setdefault("throttle", 1)
         data = URL(url).download(**kwargs)
         data = re.search(r"http://upload.wikimedia.org/.*?/%s" % media, data)
         data = data and URL(data.group(0)).download(**kwargs) or None
@@ -1365,6 +2032,8 @@ class Flickr(SearchEngine):
             # 7: "No known copyright restriction"
             url.query["license"] = "5,7"
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = url.download(cached=cached, **kwargs)
         data = xml.dom.minidom.parseString(bytestring(data))
         results = Results(FLICKR, query, type)
@@ -1441,6 +2110,8 @@ class Products(SearchEngine):
             "format": "json"
         })
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = URL(url).download(cached=cached, **kwargs)
         data = json.loads(data)
         results = Results(PRODUCTWIKI, query, type)
@@ -1473,17 +2144,211 @@ class Products(SearchEngine):
 
 from feed import feedparser
 
+try:
+    from xml.etree import cElementTree as ElementTree
+except:
+    from xml.etree import ElementTree
+
+# The feedparser handles any feed (including malformed XML), but it is slow:
+# each feed passes through sgmllib and the HTML sanitizer.
+# Most feeds are well-formed RSS 2.0 or Atom, for which parse_feed() uses a faster path
+# that streams the XML and only extracts the fields used by Newsfeed.
+ATOM    = "{http://www.w3.org/2005/Atom}"
+DC      = "{http://purl.org/dc/elements/1.1/}"
+CONTENT = "{http://purl.org/rss/1.0/modules/content/}"
+XML     = "{http://www.w3.org/XML/1998/namespace}"
+
+class FeedFormatError(Exception):
+    pass # Not a RSS 2.0 or Atom feed.
+
+def _text(e):
+    # Returns the text content of the element (the serialized children for XHTML content).
+    if e.get("type") == "xhtml":
+        for x in e.getiterator():
+            x.tag = x.tag.split("}")[-1] # <div xmlns="http://www.w3.org/1999/xhtml">
+        s = [e.text or ""] + [ElementTree.tostring(x, encoding="utf-8").decode("utf-8") for x in e]
+        return "".join(s).strip()
+    return e.text and unicode(e.text).strip() or u""
+
+def _entry(e, language=None):
+    # Returns a dict with the feedparser keys for the given <item> or <entry> element.
+    x = {}
+    for child in e:
+        tag, value = child.tag, _text(child)
+        if tag in ("title", ATOM+"title"):
+            x["title"] = value
+        elif tag == "link":
+            x["link"] = value
+        elif tag == ATOM+"link" and child.get("rel", "alternate") == "alternate":
+            x.setdefault("link", unicode(child.get("href", u"")))
+        elif tag in ("guid", ATOM+"id"):
+            x["id"] = value
+            if tag == "guid" and child.get("isPermaLink", "true") == "true":
+                x.setdefault("guidlink", value)
+        elif tag in ("description", ATOM+"summary"):
+            x["summary"] = value
+        elif tag in (CONTENT+"encoded", ATOM+"content"):
+            x.setdefault("content", []).append({
+                "value": value, "language": child.get(XML+"lang", e.get(XML+"lang", language))})
+        elif tag in ("pubDate", DC+"date", ATOM+"updated"):
+            x["updated"] = value
+        elif tag == ATOM+"published":
+            x["published"] = value
+        elif tag in ("author", DC+"creator", ATOM+"author"):
+            x["author"] = value or child.findtext(ATOM+"name", u"").strip()
+    if "link" not in x and "guidlink" in x:
+        x["link"] = x["guidlink"]
+    x.pop("guidlink", None)
+    for k in ("updated", "published"):
+        if k in x:
+            x[k+"_parsed"] = feedparser._parse_date(x[k])
+    return x
+
+def _iterparse_feed(data):
+    """ Returns a dict with "entries" and "language" (like feedparser.parse()) for the given XML string.
+        Raises a SyntaxError if the XML is malformed, FeedFormatError if it is not RSS 2.0 or Atom.
+        HTML in the content is not sanitized.
+    """
+    entries, language, root = [], None, None
+    for event, e in ElementTree.iterparse(StringIO.StringIO(data), events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = e
+                if e.tag == "rss" and e.get("version", "2.0").startswith(("2.", "0.9")):
+                    continue
+                if e.tag == ATOM+"feed":
+                    language = e.get(XML+"lang")
+                    continue
+                raise FeedFormatError, e.tag
+        elif e.tag == "language":
+            language = _text(e)
+        elif e.tag in ("item", ATOM+"entry"):
+            entries.append(_entry(e, language))
+            # Entries are discarded once parsed, so memory use doesn't grow with the feed.
+            e.clear()
+    return {"entries": entries, "language": language}
+
+def parse_feed(data):
+    """ Returns the parsed RSS or Atom feed, as a dict with "entries" and "language".
+        Well-formed RSS 2.0 and Atom feeds are parsed with expat, other feeds with feedparser.
+    """
+    try:
+        return _iterparse_feed(bytestring(data))
+    except (SyntaxError, FeedFormatError):
+        return feedparser.parse(bytestring(data))
+
+# Number of simultaneous connections per host in Newsfeed.aggregate().
+PER_HOST = 2
+
+def _title_hash(title):
+    # Titles that differ only in case, punctuation or markup count as duplicates.
+    # Returns None for an empty title (entries without a title are not duplicates of each other).
+    s = plaintext(title or "").lower()
+    s = re.sub(r"\W+", " ", s, flags=re.UNICODE).strip()
+    return s and hashlib.md5(encode_utf8(s)).hexdigest() or None
+
 class Newsfeed(SearchEngine):
     
     def __init__(self, license=None, throttle=1.0):
         SearchEngine.__init__(self, license, throttle)
+        self.ttl = 10 * 60
+        self._validators = {} # Feed URL => (ETag, Last-Modified).
+        self._seen       = {} # Feed URL => set of entry id's (or links).
     
     def search(self, query, type=NEWS, start=1, count=10, sort=LATEST, size=SMALL, cached=True, **kwargs):
         """ Returns a list of results from the given RSS or Atom newsfeed URL.
         """ 
         kwargs.setdefault("throttle", self.throttle)
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
         data = URL(query).download(cached=cached, **kwargs)
-        data = feedparser.parse(bytestring(data))
+        return self._parse(query, parse_feed(data))
+    
+    def poll(self, query, timeout=10, **kwargs):
+        """ Returns a list of results from the given newsfeed URL that were not returned before.
+            The feed is requested with the ETag and Last-Modified headers of the previous poll,
+            so when the server answers 304 Not Modified nothing is downloaded or parsed.
+        """
+        h = {}
+        etag, modified = self._validators.get(query, (None, None))
+        if etag:
+            h["If-None-Match"] = etag
+        if modified:
+            h["If-Modified-Since"] = modified
+        kwargs.setdefault("opener", self.opener)
+        try:
+            connection = URL(query).open(timeout, headers=h, **kwargs)
+        except HTTP304NotModified:
+            return Results(query, query, NEWS)
+        data = parse_feed(connection.read())
+        info = connection.info()
+        self._validators[query] = (info.get("ETag"), info.get("Last-Modified"))
+        # Only the entries in the latest version of the feed are remembered,
+        # entries that dropped out of the feed don't come back.
+        seen = self._seen.get(query, set())
+        results = Results(query, query, NEWS)
+        results.total = None
+        ids = set()
+        for x, r in zip(data["entries"], self._parse(query, data)):
+            id = x.get("id") or x.get("link")
+            if id not in seen:
+                results.append(r)
+            ids.add(id)
+        self._seen[query] = ids
+        return results
+    
+    def aggregate(self, feeds, cached=True, threads=8, per_host=PER_HOST, **kwargs):
+        """ Yields results from the given list (or dict) of newsfeed URLs.
+            Feeds are downloaded and parsed concurrently on a number of threads,
+            with at most per_host simultaneous connections to the same server.
+            The results of each feed are yielded as soon as the feed is parsed, latest-first,
+            so the total time is roughly that of the slowest feed instead of the sum of all feeds.
+            Entries with the same link or the same (normalized) title are yielded only once.
+            For a feed that fails, the Exception is yielded instead (Exception.url is the feed URL).
+        """
+        if isinstance(feeds, dict):
+            feeds = feeds.values()
+        feeds = list(set(feeds))
+        pool  = WorkerPool(threads=min(threads, len(feeds) or 1))
+        hosts = {}
+        lock  = threading.Lock()
+        queue = Queue.Queue()
+        kwargs["throttle"] = 0
+        kwargs.setdefault("ttl", self.ttl)
+        kwargs.setdefault("opener", self.opener)
+        def fetch(url):
+            host = URL(url).domain
+            with lock:
+                h = hosts.setdefault(host, threading.BoundedSemaphore(per_host))
+            try:
+                with h:
+                    data = URL(url).download(cached=cached, **kwargs)
+                data = parse_feed(data)
+                # Sort by the parsed date, entries without a date last.
+                a = [(tuple(x.get("updated_parsed") or x.get("published_parsed") or ()), r) 
+                        for x, r in zip(data["entries"], self._parse(url, data))]
+                a = [r for date, r in sorted(a, key=lambda (date, r): date, reverse=True)]
+            except Exception, e:
+                e.url = url
+                a = [e]
+            queue.put(a)
+        for url in feeds:
+            pool.submit(fetch, url)
+        pool.close()
+        links, titles = set(), set()
+        for i in range(len(feeds)):
+            for r in queue.get():
+                if isinstance(r, Exception):
+                    yield r
+                    continue
+                h = _title_hash(r.title)
+                if r.url and r.url in links or h and h in titles:
+                    continue
+                links.add(r.url)
+                titles.add(h)
+                yield r
+    
+    def _parse(self, query, data):
         results = Results(query, query, NEWS)
         results.total = None
         for x in data["entries"]:
@@ -1517,6 +2382,43 @@ feeds = {
 #    print plaintext(r.description)
 #    print
 
+#for r in Newsfeed().aggregate(feeds):
+#    if isinstance(r, Exception):
+#        print "error:", r.url, r
+#    else:
+#        print r.date, r.title
+
+def feed_benchmark(path, iterations=10):
+    """ Compares the parse time of parse_feed() and feedparser.parse() 
+        for the saved feeds (*.xml) in the given folder.
+        If the folder is empty, the feeds in the feeds dictionary are downloaded to it first.
+    """
+    import glob
+    if not glob.glob(os.path.join(path, "*.xml")):
+        for name, url in feeds.items():
+            try: 
+                open(os.path.join(path, "%s.xml" % name), "wb").write(URL(url).open().read())
+            except URLError:
+                pass
+    corpus = [open(f, "rb").read() for f in glob.glob(os.path.join(path, "*.xml"))]
+    fast = sum(1 for data in corpus if not _is_malformed(data))
+    print "%s feeds, %s well-formed RSS 2.0 / Atom" % (len(corpus), fast)
+    for name, parse in (("parse_feed", parse_feed), ("feedparser", feedparser.parse)):
+        t = time.time()
+        for i in range(iterations):
+            for data in corpus:
+                parse(data)
+        t = time.time() - t
+        print "%-10s %.1f ms/feed" % (name, 1000 * t / (iterations * len(corpus) or 1))
+
+def _is_malformed(data):
+    try: 
+        _iterparse_feed(data); return False
+    except (SyntaxError, FeedFormatError):
+        return True
+
+#feed_benchmark("feeds")
+
 #--- WEB SORT ----------------------------------------------------------------------------------------
 
 SERVICES = {
@@ -1540,14 +2442,19 @@ def sort(terms=[], context="", service=GOOGLE, license=None, strict=True, revers
         - license : web service license id,
         - strict  : when True the query constructed from term + context is wrapped in quotes.
     """
-    service = SERVICES.get(service, SearchEngine)(license, language=kwargs.pop("language"))
-    R = []
+    service = SERVICES.get(service, SearchEngine)(license, language=kwargs.pop("language", None))
+    Q = []
     for word in terms:
         q = reverse and context+" "+word or word+" "+context
         q.strip()
         q = strict and "\"%s\"" % q or q
-        r = service.search(q, count=1, **kwargs)
-        R.append(r)        
+        Q.append(q)
+    # The searches for the different terms run concurrently.
+    R = []
+    for q, r in service.search_many(Q, count=1, **kwargs):
+        if isinstance(r, Exception):
+            raise r
+        R.append(r)
     s = float(sum([r.total for r in R])) or 1.0
     R = [(r.total/s, r.query) for r in R]
     R = sorted(R, reverse=True)    
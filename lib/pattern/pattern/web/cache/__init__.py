@@ -39,6 +39,13 @@ import glob
 import tempfile
 import codecs
 import datetime
+import zlib
+import threading
+import time
+import sys
+import sqlite3
+
+from collections import OrderedDict
 
 try: 
     MODULE = os.path.dirname(__file__)
@@ -47,12 +54,39 @@ except:
 
 TMP = os.path.join(tempfile.gettempdir(), "pattern_web")
 
+# Values larger than COMPRESS bytes are stored compressed with zlib (None = never).
+# Compressed entries start with a header byte, other entries with the UTF-8 BOM,
+# so entries stored without compression remain readable.
+COMPRESS = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSED = "\x01"
+
+def pack(v, compress=COMPRESS):
+    """ Returns the given value as a byte string to store in the cache.
+    """
+    v = encode_utf8(v)
+    if compress is not None and len(v) > compress:
+        return COMPRESSED + zlib.compress(v, COMPRESSION_LEVEL)
+    return codecs.BOM_UTF8 + v
+
+def unpack(v):
+    """ Returns the given stored byte string as a unicode string.
+    """
+    if v[:1] == COMPRESSED:
+        return decode_utf8(zlib.decompress(v[1:]))
+    return decode_utf8(v.lstrip(codecs.BOM_UTF8))
+
+# Files stored along with a cached item (see URL.save()) are named after the item + BLOB.
+BLOB = ".blob"
+
 def date_now():
     return datetime.datetime.today()
 def date_modified(path):
     return datetime.datetime.fromtimestamp(os.stat(path)[8])
 
 class Cache(object):
+
+    compress = COMPRESS
     
     def __init__(self, path=os.path.join(MODULE, "tmp")):
         """ Cache with data stored as files with hashed filenames.
@@ -82,34 +116,522 @@ class Cache(object):
     
     def __getitem__(self, k):
         if k in self:
-            f = open(self._hash(k), "rb"); v=f.read().lstrip(codecs.BOM_UTF8)
+            f = open(self._hash(k), "rb"); v=f.read()
             f.close()
-            return decode_utf8(v)
+            return unpack(v)
         raise KeyError, k
 
     def __setitem__(self, k, v):
         f = open(self._hash(k), "wb")
-        f.write(codecs.BOM_UTF8)
-        f.write(encode_utf8(v))
+        f.write(pack(v, self.compress))
         f.close()
 
     def __delitem__(self, k):
-        try: os.unlink(self._hash(k))
-        except OSError:
-            pass
+        for p in (self._hash(k), self._hash(k) + BLOB):
+            try: os.unlink(p)
+            except OSError:
+                pass
+
+    def blob(self, k):
+        """ Returns the path of the file stored along with the cached item (see URL.save()).
+            The file is removed together with the item.
+        """
+        return self._hash(k) + BLOB
 
     def age(self, k):
         """ Returns the age of the cached item, in days.
         """
         p = self._hash(k)
         return os.path.exists(p) and (date_now() - date_modified(p)).days or 0
+
+    def timestamp(self, k):
+        """ Returns the time the cached item was stored, in seconds since the epoch (or 0).
+        """
+        try: return os.path.getmtime(self._hash(k))
+        except OSError:
+            return 0
             
     def clear(self, age=None):
         """ Clears all items from the cache (whose age is the given amount of days or older).
         """
         n = date_now()
         for p in glob.glob(os.path.join(self.path, "*")):
-            if age is None or (n - date_modified(p)).days >= age:
+            if os.path.isfile(p) and (age is None or (n - date_modified(p)).days >= age):
                 os.unlink(p)
         
-cache = Cache()
\ No newline at end of file
+#### LRU CACHE #######################################################################################
+# With Cache, the folder keeps on growing, and since all files are in the same folder,
+# lookups become slower when it contains many thousands of files.
+# LRUCache stores files in two levels of subfolders (e.g., 3a/f2/3af2...),
+# and removes the least recently used files when it exceeds a size (in bytes) or number of entries.
+# File sizes and access times are kept in an index in memory, 
+# built from a single scan of the folder when the cache is first used.
+# Blobs are in the index too (counting as entries), and are removed together with their item.
+
+# Default size of the cache used by URL.download().
+CACHE_SIZE = 256 * 1024 * 1024
+
+# Items (with their blob) larger than this fraction of the size are not cached,
+# so that a single large item doesn't evict (nearly) all other items.
+MAX_ITEM = 0.25
+
+class LRUCache(Cache):
+
+    def __init__(self, path=os.path.join(MODULE, "tmp"), size=CACHE_SIZE, entries=None):
+        """ Cache with a maximum size in bytes and/or a maximum number of entries (None = no limit).
+            Files from a Cache with the same path are moved into the new layout when the index is built.
+        """
+        self._lock  = threading.RLock()
+        self._index = None
+        self.size    = size
+        self.entries = entries
+        Cache.__init__(self, path)
+
+    def _set_path(self, path):
+        Cache._set_path(self, path)
+        self._index = None
+    path = property(Cache._get_path, _set_path)
+
+    def _hash(self, k):
+        h = md5(encode_utf8(k)).hexdigest()
+        return os.path.join(self.path, h[:2], h[2:4], h)
+
+    @property
+    def index(self):
+        """ Yields an OrderedDict of (path, size)-items, least recently used first.
+        """
+        with self._lock:
+            if self._index is None:
+                self._flatten()
+                a = []
+                for p in glob.glob(os.path.join(self.path, "??", "??", "*")):
+                    if p.endswith(".part"):
+                        continue # A blob that is being written.
+                    s = os.stat(p)
+                    a.append((s.st_atime, p, s.st_size))
+                self._index = OrderedDict((p, n) for t, p, n in sorted(a))
+                self._bytes = sum(self._index.values())
+                self._evict()
+            return self._index
+
+    def _flatten(self):
+        # Moves all files in the flat Cache layout into the subfolders,
+        # so that they are counted in the index (and can be evicted).
+        for p1 in glob.glob(os.path.join(self.path, "*")):
+            h = os.path.basename(p1)
+            if not os.path.isfile(p1) or len(h.split(".")[0]) != 32 or h[32:] not in ("", BLOB):
+                continue
+            p2 = os.path.join(self.path, h[:2], h[2:4], h)
+            if not os.path.isdir(os.path.dirname(p2)):
+                os.makedirs(os.path.dirname(p2))
+            if os.path.exists(p2):
+                os.unlink(p1) # Already migrated (and more recent).
+            else:
+                os.rename(p1, p2)
+
+    def _touch(self, p, size=None):
+        # Moves the given path to the end of the index (i.e., most recently used).
+        with self._lock:
+            n = self.index.pop(p, None)
+            if n is not None:
+                self._bytes -= n
+            if size is not None:
+                self._index[p] = size
+                self._bytes += size
+
+    def _evict(self):
+        with self._lock:
+            while self._index and (self.size is not None and self._bytes > self.size \
+                               or self.entries is not None and len(self._index) > self.entries):
+                p, n = self._index.popitem(last=False)
+                self._bytes -= n
+                # An item and its blob are removed together.
+                q = p.endswith(BLOB) and p[:-len(BLOB)] or p + BLOB
+                self._touch(q)
+                for x in (p, q):
+                    try: os.unlink(x)
+                    except OSError:
+                        pass
+
+    def _add(self, p):
+        # Adds the file at the given path (and its blob) to the index, and evicts other files.
+        # Returns False if the file is too large to be cached, in which case it is removed.
+        n1 = os.path.getsize(p)
+        n2 = os.path.exists(p + BLOB) and os.path.getsize(p + BLOB) or 0
+        if self.size is not None and n1 + n2 > self.size * MAX_ITEM:
+            for x in (p, p + BLOB):
+                self._touch(x)
+                try: os.unlink(x)
+                except OSError:
+                    pass
+            return False
+        self._touch(p, n1)
+        if n2:
+            self._touch(p + BLOB, n2)
+        self._evict()
+        return True
+
+    def _migrate(self, k):
+        # Moves the file for the given key from the flat Cache layout to the subfolders.
+        p1 = Cache._hash(self, k)
+        p2 = self._hash(k)
+        if os.path.exists(p1):
+            if not os.path.isdir(os.path.dirname(p2)):
+                os.makedirs(os.path.dirname(p2))
+            os.rename(p1, p2)
+            return self._add(p2)
+        return False
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, k):
+        return os.path.exists(self._hash(k)) or self._migrate(k)
+
+    def __getitem__(self, k):
+        v = Cache.__getitem__(self, k)
+        p = self._hash(k)
+        # The access time is stored in the file, so that the order is kept across sessions.
+        # The modification time is left unchanged, since it is used for Cache.age().
+        try: os.utime(p, (time.time(), os.stat(p).st_mtime))
+        except OSError:
+            pass
+        self._touch(p, self.index.get(p) or os.path.getsize(p))
+        if p + BLOB in self.index:
+            self._touch(p + BLOB, self.index[p + BLOB])
+        return v
+
+    def __setitem__(self, k, v):
+        p = self._hash(k)
+        if not os.path.isdir(os.path.dirname(p)):
+            os.makedirs(os.path.dirname(p))
+        Cache.__setitem__(self, k, v)
+        self._add(p)
+
+    def __delitem__(self, k):
+        Cache.__delitem__(self, k)
+        self._touch(self._hash(k))
+        self._touch(self._hash(k) + BLOB)
+
+    def blob(self, k):
+        p = Cache.blob(self, k)
+        if not os.path.isdir(os.path.dirname(p)):
+            os.makedirs(os.path.dirname(p))
+        return p
+
+    @property
+    def bytes(self):
+        """ Yields the total size of the cached files.
+        """
+        self.index; return self._bytes
+
+    def clear(self, age=None):
+        """ Clears all items from the cache (whose age is the given amount of days or older).
+        """
+        n = date_now()
+        Cache.clear(self, age)
+        for p in self.index.keys():
+            if age is None or not os.path.exists(p) or (n - date_modified(p)).days >= age:
+                self._touch(p)
+                if os.path.exists(p):
+                    os.unlink(p)
+
+#### MEMORY CACHE ####################################################################################
+# A cache hit on disk still opens, reads and decodes a file.
+# MemoryCache keeps the most recently used (decoded) values in memory, in front of another cache.
+
+# Default size of the memory used by URL.download(), in bytes (0 = disabled).
+# It can be configured with the PATTERN_MEMORY environment variable.
+# At runtime, the memory can be turned off with cache.size = 0.
+MEMORY_SIZE = int(os.environ.get("PATTERN_MEMORY", 16 * 1024 * 1024))
+
+class MemoryCache(object):
+
+    def __init__(self, cache, size=MEMORY_SIZE):
+        """ Cache that keeps up to the given amount of bytes of values in memory,
+            and reads and writes all other values from/to the given Cache.
+            MemoryCache.hits and MemoryCache.misses count the number of lookups.
+        """
+        self.cache  = cache
+        self.hits   = 0
+        self.misses = 0
+        self._lock  = threading.RLock()
+        self._items = OrderedDict() # key => (value, bytes), least recently used first.
+        self._bytes = 0
+        self._size  = size
+
+    def _get_size(self):
+        return self._size
+    def _set_size(self, size):
+        # Values that no longer fit are removed (size=0 empties the memory).
+        with self._lock:
+            self._size = size
+            while self._bytes > self._size:
+                self._bytes -= self._items.popitem(last=False)[1][1]
+    size = property(_get_size, _set_size)
+
+    def _get_path(self):
+        return self.cache.path
+    def _set_path(self, path):
+        self.cache.path = path
+        self.flush()
+    path = property(_get_path, _set_path)
+
+    def _get_compress(self):
+        return self.cache.compress
+    def _set_compress(self, compress):
+        self.cache.compress = compress
+    compress = property(_get_compress, _set_compress)
+
+    def _pop(self, k):
+        v = self._items.pop(k, None)
+        if v is not None:
+            self._bytes -= v[1]
+        return v
+
+    def _push(self, k, v):
+        n = sys.getsizeof(v)
+        if n > self.size:
+            return
+        self._items[k] = (v, n)
+        self._bytes += n
+        while self._bytes > self.size:
+            self._bytes -= self._items.popitem(last=False)[1][1]
+
+    def flush(self):
+        """ Clears the values in memory (values on disk are kept).
+        """
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, k):
+        return k in self._items or k in self.cache
+
+    def __getitem__(self, k):
+        with self._lock:
+            v = self._pop(k)
+            if v is not None:
+                self.hits += 1
+                self._push(k, v[0])
+                return v[0]
+            self.misses += 1
+        v = self.cache[k]
+        with self._lock:
+            self._pop(k)
+            self._push(k, v)
+        return v
+
+    def __setitem__(self, k, v):
+        with self._lock:
+            self._pop(k)
+        self.cache[k] = v
+
+    def __delitem__(self, k):
+        with self._lock:
+            self._pop(k)
+        del self.cache[k]
+
+    @property
+    def bytes(self):
+        """ Yields the total size of the values in memory.
+        """
+        return self._bytes
+
+    def blob(self, k):
+        return self.cache.blob(k)
+
+    def age(self, k):
+        return self.cache.age(k)
+
+    def timestamp(self, k):
+        return self.cache.timestamp(k)
+
+    def clear(self, age=None):
+        self.flush()
+        self.cache.clear(age)
+
+#### SQLITE CACHE ####################################################################################
+# SQLiteCache stores all entries in a single database file instead of one file per entry.
+# The database uses write-ahead logging, so readers don't block the writer (and vice versa),
+# and each thread has its own connection.
+
+class SQLiteCache(object):
+
+    compress = COMPRESS
+
+    def __init__(self, path=os.path.join(MODULE, "cache.db")):
+        """ Cache with data stored in a SQLite database.
+            If the given path is a folder, the database is stored as cache.db in the folder.
+            Along with each value, the HTTP ETag and Last-Modified headers can be stored.
+        """
+        self._local = threading.local()
+        self.path = path
+
+    def _get_path(self):
+        return self._path
+    def _set_path(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, "cache.db")
+        self._path = path
+        self._local = threading.local()
+        self.db.executescript("""
+            create table if not exists cache (
+                hash     text primary key,
+                value    blob,
+                created  real,
+                accessed real,
+                etag     text,
+                modified text
+            );""")
+    path = property(_get_path, _set_path)
+
+    @property
+    def db(self):
+        # A sqlite3 connection can only be used in the thread that created it.
+        if getattr(self._local, "db", None) is None:
+            self._local.db = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            self._local.db.execute("pragma journal_mode=wal")
+            self._local.db.execute("pragma synchronous=normal")
+        return self._local.db
+
+    def _hash(self, k):
+        return md5(encode_utf8(k)).hexdigest()
+
+    def __len__(self):
+        return self.db.execute("select count(*) from cache").fetchone()[0]
+
+    def __contains__(self, k):
+        return self.db.execute("select 1 from cache where hash=?", (self._hash(k),)).fetchone() is not None
+
+    def __getitem__(self, k):
+        h = self._hash(k)
+        r = self.db.execute("select value from cache where hash=?", (h,)).fetchone()
+        if r is None:
+            raise KeyError, k
+        self.db.execute("update cache set accessed=? where hash=?", (time.time(), h))
+        return unpack(str(r[0]))
+
+    def __setitem__(self, k, v):
+        self.set(k, v)
+
+    def __delitem__(self, k):
+        self.db.execute("delete from cache where hash=?", (self._hash(k),))
+        self._unlink(self._hash(k))
+
+    def _blobs(self):
+        # Blobs are stored as files in a blobs folder next to the database.
+        return os.path.join(os.path.dirname(os.path.abspath(self._path)), "blobs")
+
+    def _unlink(self, h):
+        try: os.unlink(os.path.join(self._blobs(), h + BLOB))
+        except OSError:
+            pass
+
+    def blob(self, k):
+        """ Returns the path of the file stored along with the cached item (see URL.save()).
+            The file is removed together with the item.
+        """
+        if not os.path.isdir(self._blobs()):
+            os.makedirs(self._blobs())
+        return os.path.join(self._blobs(), self._hash(k) + BLOB)
+
+    def set(self, k, v, etag=None, modified=None):
+        """ Stores the given value, with the HTTP ETag and Last-Modified headers of the response.
+        """
+        t = time.time()
+        self.db.execute("insert or replace into cache values (?, ?, ?, ?, ?, ?)", 
+            (self._hash(k), sqlite3.Binary(pack(v, self.compress)), t, t, etag, modified))
+
+    def validators(self, k):
+        """ Returns an (ETag, Last-Modified)-tuple for the given key, or (None, None).
+        """
+        r = self.db.execute("select etag, modified from cache where hash=?", (self._hash(k),)).fetchone()
+        return r and tuple(r) or (None, None)
+
+    def age(self, k):
+        """ Returns the age of the cached item, in days.
+        """
+        r = self.db.execute("select created from cache where hash=?", (self._hash(k),)).fetchone()
+        return r and (date_now() - datetime.datetime.fromtimestamp(r[0])).days or 0
+
+    def timestamp(self, k):
+        """ Returns the time the cached item was stored, in seconds since the epoch (or 0).
+        """
+        r = self.db.execute("select created from cache where hash=?", (self._hash(k),)).fetchone()
+        return r and r[0] or 0
+
+    def clear(self, age=None):
+        """ Clears all items from the cache (whose age is the given amount of days or older).
+        """
+        if age is None:
+            self.db.execute("delete from cache")
+            for p in glob.glob(os.path.join(self._blobs(), "*" + BLOB)):
+                os.unlink(p)
+        else:
+            t = time.time() - age * 86400
+            for h, in self.db.execute("select hash from cache where created<=?", (t,)).fetchall():
+                self._unlink(h)
+            self.db.execute("delete from cache where created<=?", (t,))
+
+def migrate(path, cache):
+    """ Copies the files of a Cache or LRUCache in the given folder to the given SQLiteCache
+        (or a MemoryCache in front of a SQLiteCache).
+        Returns the number of entries copied.
+    """
+    if isinstance(cache, MemoryCache):
+        cache.flush()
+        cache = cache.cache
+    n = 0
+    for p in glob.glob(os.path.join(path, "*")) + glob.glob(os.path.join(path, "??", "??", "*")):
+        if os.path.isfile(p) and len(os.path.basename(p)) == 32:
+            f = open(p, "rb"); v=f.read()
+            f.close()
+            s = os.stat(p)
+            # Files are named after the MD5 hash of the key, which is also the SQLiteCache key.
+            cache.db.execute("insert or replace into cache values (?, ?, ?, ?, ?, ?)", 
+                (os.path.basename(p), sqlite3.Binary(v), s.st_mtime, s.st_atime, None, None))
+            n += 1
+    return n
+
+#### COMPRESSION BENCHMARK ###########################################################################
+
+def compression_benchmark(path=os.path.join(MODULE, "tmp"), compress=COMPRESS):
+    """ Prints the size of the cached files in the given folder, with and without compression,
+        and the time it takes to read a value in both cases.
+    """
+    a = [p for p in glob.glob(os.path.join(path, "*")) + glob.glob(os.path.join(path, "??", "??", "*"))
+        if os.path.isfile(p)]
+    a = [unpack(open(p, "rb").read()) for p in a]
+    a = [(pack(v, None), pack(v, compress)) for v in a]
+    if not a:
+        return
+    for i, name in ((0, "plain"), (1, "compressed")):
+        t = time.time()
+        for v in a:
+            unpack(v[i])
+        t = time.time() - t
+        print "%-10s %6.1f KB %.3f ms/entry" % (name, sum(len(v[i]) for v in a) / 1024.0, 1000 * t / len(a))
+
+#compression_benchmark()
+
+#### CACHE ###########################################################################################
+# The cache used by URL.download() can be configured with the PATTERN_CACHE environment variable:
+# - "files"  : Cache, one file per entry,
+# - "lru"    : LRUCache, one file per entry in subfolders, with a maximum size (default),
+# - "sqlite" : SQLiteCache, a single database file.
+# The PATTERN_MEMORY environment variable sets the size of the MemoryCache in front of it (0 = none).
+
+CACHE = os.environ.get("PATTERN_CACHE", "lru")
+
+if CACHE == "sqlite":
+    cache = SQLiteCache()
+elif CACHE == "files":
+    cache = Cache()
+else:
+    cache = LRUCache()
+if MEMORY_SIZE:
+    cache = MemoryCache(cache)
\ No newline at end of file
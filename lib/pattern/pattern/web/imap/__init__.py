@@ -11,6 +11,9 @@ import imaplib
 import re
 import email
 import time
+import threading
+import select
+import sqlite3
 
 try: 
     MODULE = os.path.dirname(__file__)
@@ -68,8 +71,8 @@ class IMAP4_SSL(imaplib.IMAP4_SSL):
 
 GMAIL = "imap.gmail.com"
 
-DATE, FROM, SUBJECT, BODY, ATTACHMENTS = \
-    "date", "from", "subject", "body", "attachments"
+DATE, FROM, SUBJECT, BODY, ATTACHMENTS, UID = \
+    "date", "from", "subject", "body", "attachments", "uid"
     
 def _basename(folder):
     # [Gmail]/INBOX => inbox
@@ -90,19 +93,30 @@ class MailNotLoggedIn(MailError):
 
 class Mail(object):
     
-    def __init__(self, username, password, service=GMAIL, port=993):
+    def __init__(self, username, password, service=GMAIL, port=993, store=None):
+        """ An IMAP mail account.
+            With a MailStore, messages can be synced to a local database with MailFolder.sync()
+            and searched offline with MailFolder.find().
+        """
         self._username = username
         self._password = password
         self._host     = service
         self._port     = port
         self._imap4    = None
         self._folders  = None
+        self._selected = None
+        self.store     = store
         self.login(username, password)
 
     @property
     def _id(self):
         return "%s:%s@%s:%s" % (self._username, self._password, self._host, self._port)
 
+    @property
+    def account(self):
+        # Identifies the account in a MailStore (without the password).
+        return "%s@%s:%s" % (self._username, self._host, self._port)
+
     @property
     def imap4(self):
         if self._imap4 is None: 
@@ -114,6 +128,7 @@ class Mail(object):
             raises a MailLoginError otherwise.
         """
         self._imap4 = IMAP4_SSL(self._host, self._port)
+        self._selected = None
         try:
             status, response = self._imap4.login(username, password)
         except:
@@ -127,6 +142,37 @@ class Mail(object):
         if self._imap4 is not None:
             self._imap4.logout()
             self._imap4 = None
+            self._selected = None
+
+    def select(self, folder, refresh=False):
+        """ Selects the given folder (read-only) and returns the number of messages in it.
+            The connection stays logged in, and a folder that is already selected
+            is not selected again (unless refresh=True), so consecutive calls
+            on the same folder don't pay a round-trip for each call.
+        """
+        if refresh or self._selected is None or self._selected[0] != folder:
+            status, response = self.imap4.select(folder, readonly=1)
+            if status != "OK":
+                raise MailError, response
+            self._selected = (folder, int(response[0]))
+        return self._selected[1]
+
+    @property
+    def alive(self):
+        """ Yields True if the connection is still logged in.
+        """
+        try:
+            return self.imap4.noop()[0] == "OK"
+        except:
+            return False
+
+    def reconnect(self):
+        """ Logs in again (e.g., after the server closed an idle connection).
+        """
+        try: self.logout()
+        except:
+            self._imap4 = None
+        self.login(self._username, self._password)
         
     def __del__(self):
         if "_imap4" in self.__dict__:
@@ -173,6 +219,45 @@ def _decode(s, message):
                 pass 
     return s
 
+def _sequence_set(indices):
+    # [0,1,2,5] => "1:3,6" (message sequence numbers start at 1).
+    n = sorted(set(i+1 for i in indices))
+    s = []
+    for i in n:
+        if s and s[-1][1] == i-1:
+            s[-1][1] = i
+        else:
+            s.append([i, i])
+    return ",".join(a == b and str(a) or "%s:%s" % (a, b) for a, b in s)
+
+RE_FETCH_MESSAGE = re.compile(r"^(\d+) \(")
+RE_FETCH_SECTION = re.compile(r"BODY\[([A-Z.]*)\]")
+RE_FETCH_UID     = re.compile(r"UID (\d+)")
+
+def _parse_fetch(response, uid=False):
+    # Returns a dictionary of (sequence number, raw message)-items from a FETCH response.
+    # Each message in the response is a list of ("1 (BODY[HEADER] {342}", header)-tuples
+    # (one for each section), followed by the ")" string.
+    # With uid=True, the dictionary keys are UIDs (the UID can be in the tuple or in the string).
+    sections = {}
+    uids = {}
+    n = None
+    for x in response:
+        if isinstance(x, tuple):
+            m = RE_FETCH_MESSAGE.match(x[0])
+            if m:
+                n = int(m.group(1))
+            m = RE_FETCH_SECTION.search(x[0])
+            sections.setdefault(n, {})[m and m.group(1) or ""] = x[1]
+            x = x[0]
+        m = isinstance(x, str) and RE_FETCH_UID.search(x)
+        if m:
+            uids[n] = int(m.group(1))
+    sections = dict((n, d.get("HEADER", "") + d.get("TEXT", "") + d.get("", "")) for n, d in sections.items())
+    if uid:
+        return dict((uids[n], v) for n, v in sections.items() if n in uids)
+    return sections
+
 class MailFolder:
     
     def __init__(self, parent, name):
@@ -202,7 +287,7 @@ class MailFolder:
         if cached and id in cache:
             status, response = "OK", [cache[id]]
         else:
-            status, response = self.parent.imap4.select(self.name, readonly=1)
+            self.parent.select(self.name)
             status, response = self.parent.imap4.search(None, field.upper(), q)
             if cached:
                 cache[id] = response[0]
@@ -216,22 +301,35 @@ class MailFolder:
             Each message is a dictionary with date, from, subject, body, attachments entries.
             The attachments entry is a list of (MIME-type, str)-tuples.
         """
-        i += 1
-        id = "mail-%s-%s-%s-%s" % (self.parent._id, self.name, i, attachments)
-        if cached and id in cache:
-            m = cache[id]
-        else:
+        return self.fetch([i], attachments, cached)[0]
+
+    def fetch(self, indices, attachments=False, cached=True):
+        """ Returns a list of mail messages for the given list of indices (see MailFolder.search()).
+            All the messages that are not cached are retrieved with a single FETCH command.
+        """
+        id = lambda i: "mail-%s-%s-%s-%s" % (self.parent._id, self.name, i+1, attachments)
+        raw = {}
+        if cached:
+            for i in indices:
+                if id(i) in cache:
+                    raw[i] = cache[id(i)]
+        missing = [i for i in indices if i not in raw]
+        if missing:
             # Select the current mail folder.
-            # Get the e-mail header.
-            # Get the e-mail body, with or without file attachments.
-            status, response  = self.parent.imap4.select(self.name, readonly=1)
-            status, response1 = self.parent.imap4.fetch(str(i), '(BODY.PEEK[HEADER])')
-            status, response2 = self.parent.imap4.fetch(str(i), '(BODY.PEEK[%s])' % (not attachments and "TEXT" or ""))
-            time.sleep(0.1)
-            m = response1[0][1] + response2[0][1]
-            # Cache the raw message for faster retrieval.
-            if cached:
-                cache[id] = m
+            # Get the e-mail headers and bodies, with or without file attachments.
+            self.parent.select(self.name)
+            status, response = self.parent.imap4.fetch(_sequence_set(missing),
+                attachments and "(BODY.PEEK[])" or "(BODY.PEEK[HEADER] BODY.PEEK[TEXT])")
+            if status != "OK":
+                raise MailError, response
+            for n, m in _parse_fetch(response).items():
+                raw[n-1] = m
+                # Cache the raw message for faster retrieval.
+                if cached:
+                    cache[id(n-1)] = m
+        return [self._parse(raw[i], attachments) for i in indices if i in raw]
+
+    def _parse(self, m, attachments=False):
         # Parse the raw message.
         m = email.message_from_string(encode_utf8(m))
         d = Message([
@@ -259,12 +357,278 @@ class MailFolder:
             yield self[i]
 
     def __len__(self):
-        status, response = self.parent.imap4.select(self.name, readonly=1)
-        return int(response[0])
+        return self.parent.select(self.name, refresh=True)
+
+    def sync(self, body=True):
+        """ Retrieves the messages that are not yet in the local MailStore (Mail.store),
+            and removes local messages that were deleted on the server.
+            Messages are identified by UID, so only new UIDs are retrieved.
+            Returns the number of new messages.
+        """
+        store, p = self.parent.store, self.parent
+        if store is None:
+            raise MailError, "no MailStore"
+        p.select(self._name, refresh=True)
+        # If UIDVALIDITY changes, the UIDs in the folder have been reassigned by the server.
+        status, response = p.imap4.response("UIDVALIDITY")
+        validity = int(response and response[0] or 0)
+        store.validate(p.account, self._name, validity)
+        status, response = p.imap4.uid("search", None, "ALL")
+        uids = set(int(i) for i in response[0].split())
+        store.expunge(p.account, self._name, validity, uids)
+        n = 0
+        highest = store.highest(p.account, self._name, validity)
+        if max(uids or [0]) > highest:
+            status, response = p.imap4.uid("fetch", "%s:*" % (highest + 1),
+                body and "(UID BODY.PEEK[HEADER] BODY.PEEK[TEXT])" or "(UID BODY.PEEK[HEADER])")
+            if status != "OK":
+                raise MailError, response
+            for uid, m in sorted(_parse_fetch(response, uid=True).items()):
+                if uid > highest:
+                    d = self._parse(m)
+                    d[UID] = uid
+                    store.append(p.account, self._name, validity, uid, d, m)
+                    n += 1
+        return n
+
+    def find(self, q, field=FROM, sync=False):
+        """ Returns a list of Message objects for the given query from the local MailStore, latest-first.
+            The search field can be FROM, DATE, SUBJECT or BODY. Each Message has a uid entry.
+            With sync=True, new messages are retrieved from the server first (see MailFolder.sync()).
+        """
+        if sync:
+            self.sync()
+        return self.parent.store.search(self.parent.account, self._name, q, field)
+
+    def watch(self, callback, body=False):
+        """ Starts and returns a MailWatcher that calls callback(Message) for each new message.
+            The watcher keeps its own connection in IMAP IDLE mode. Use MailWatcher.stop() to stop.
+        """
+        w = MailWatcher(self, callback, body)
+        w.start()
+        return w
 
     def __repr__(self):
         return "MailFolder(name=%s)" % repr(self.name)
 
+#--- MAIL WATCHER ------------------------------------------------------------------------------------
+# IMAP IDLE (RFC 2177) keeps a connection open on which the server pushes new mail notifications,
+# so new messages arrive without polling. The connection can't be used for anything else
+# while it is idling, so a MailWatcher logs in with its own connection.
+
+IDLE_TIMEOUT = 29 * 60 # Servers may drop an idle connection after 30 minutes.
+POLL = 30              # Seconds between checks if the server doesn't support IDLE.
+
+class MailWatcher(threading.Thread):
+
+    def __init__(self, folder, callback, body=False, interval=POLL):
+        """ A background thread that calls callback(Message) for each new message in the given MailFolder.
+            Only messages with a UID higher than the highest UID seen are delivered.
+            With body=False, only the message headers are retrieved (Message.body is empty).
+        """
+        threading.Thread.__init__(self)
+        self.daemon    = True
+        self.folder    = folder
+        self.callback  = callback
+        self.body      = body
+        self.interval  = interval
+        self.uid       = None # Highest UID seen.
+        self._stopped  = False
+        self._mail     = None
+
+    def stop(self):
+        """ Stops watching (within a few seconds) and logs out.
+        """
+        self._stopped = True
+
+    def run(self):
+        p = self.folder.parent
+        while not self._stopped:
+            try:
+                if self._mail is None:
+                    self._mail = Mail(p._username, p._password, service=p._host, port=p._port)
+                    self._mail.select(self.folder._name, refresh=True)
+                    if self.uid is None:
+                        self.uid = self._uidnext() - 1
+                if "IDLE" in self._mail.imap4.capabilities:
+                    self._idle()
+                else:
+                    self._poll()
+                if not self._stopped:
+                    self._fetch()
+            except Exception:
+                # Connection dropped: log in again after a while.
+                self._logout()
+                time.sleep(self.interval)
+        self._logout()
+
+    def _logout(self):
+        try: self._mail.logout()
+        except:
+            pass
+        self._mail = None
+
+    def _uidnext(self):
+        # The UID that the next new message will get (reported when the folder is selected).
+        status, response = self._mail.imap4.response("UIDNEXT")
+        if response and response[0]:
+            return int(response[0])
+        status, response = self._mail.imap4.uid("search", None, "ALL")
+        return max([int(i) for i in response[0].split()] or [0]) + 1
+
+    def _idle(self):
+        # Sends IDLE and waits for an EXISTS response (new mail), then sends DONE.
+        imap4 = self._mail.imap4
+        sock = getattr(imap4, "sslobj", None) or imap4.sock
+        tag = imap4._new_tag()
+        imap4.send("%s IDLE\r\n" % tag)
+        if not imap4.readline().startswith("+"):
+            raise MailError, "IDLE"
+        t = time.time()
+        while not self._stopped and time.time() - t < IDLE_TIMEOUT:
+            # A socket timeout can interrupt readline() halfway a line, losing the part already read.
+            # Instead, wait until there is data with select(), and check MailWatcher.stop() every second.
+            if not self._buffered() and not select.select([sock], [], [], 1.0)[0]:
+                continue
+            line = imap4.readline()
+            if not line:
+                raise MailError, "connection closed"
+            if "EXISTS" in line:
+                break
+        imap4.send("DONE\r\n")
+        while not imap4.readline().startswith(tag):
+            pass
+
+    def _buffered(self):
+        # Returns True if data was read ahead from the socket (by the buffered file or by SSL),
+        # in which case select() doesn't report it but readline() won't block.
+        imap4 = self._mail.imap4
+        rbuf = getattr(imap4.file, "_rbuf", None)
+        if rbuf is not None and rbuf.getvalue():
+            return True
+        sslobj = getattr(imap4, "sslobj", None)
+        return sslobj is not None and sslobj.pending() > 0
+
+    def _poll(self):
+        t = time.time()
+        while not self._stopped and time.time() - t < self.interval:
+            time.sleep(1.0)
+        self._mail.imap4.noop()
+
+    def _fetch(self):
+        # Retrieves messages with a UID higher than the highest UID seen.
+        # Note: "n:*" always includes the last message, even if its UID is lower than n.
+        status, response = self._mail.imap4.uid("fetch", "%s:*" % (self.uid + 1),
+            self.body and "(UID BODY.PEEK[HEADER] BODY.PEEK[TEXT])" or "(UID BODY.PEEK[HEADER])")
+        if status != "OK":
+            raise MailError, response
+        for uid, m in sorted(_parse_fetch(response, uid=True).items()):
+            if uid > self.uid:
+                self.uid = uid
+                self.callback(self.folder._parse(m))
+
+#--- MAIL STORE --------------------------------------------------------------------------------------
+# A local SQLite database of messages, keyed by (account, folder, UIDVALIDITY, UID).
+# Unlike sequence numbers, UIDs don't change when other messages are deleted,
+# so synced messages stay valid across sessions and can be searched without the server.
+
+STORE = os.path.join(MODULE, "..", "cache", "mail.db")
+
+class MailStore(object):
+
+    def __init__(self, path=STORE):
+        """ Local storage of e-mail messages with parsed headers indexed in SQLite.
+            The store can be shared by several Mail objects (and threads).
+        """
+        self.path  = path
+        self._lock = threading.RLock()
+        self._db   = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.executescript("""
+            create table if not exists folder (
+                account     text,
+                folder      text,
+                uidvalidity integer,
+                primary key (account, folder));
+            create table if not exists message (
+                account     text,
+                folder      text,
+                uidvalidity integer,
+                uid         integer,
+                date        text,
+                sender      text,
+                subject     text,
+                body        text,
+                raw         blob,
+                primary key (account, folder, uidvalidity, uid));
+            create index if not exists message_sender  on message (account, folder, sender);
+            create index if not exists message_subject on message (account, folder, subject);
+        """)
+        self._db.commit()
+
+    def validate(self, account, folder, uidvalidity):
+        """ Removes the messages in the folder if its UIDVALIDITY has changed.
+        """
+        with self._lock:
+            r = self._db.execute("select uidvalidity from folder where account=? and folder=?", (account, folder)).fetchone()
+            if r is None or r[0] != uidvalidity:
+                self._db.execute("delete from message where account=? and folder=?", (account, folder))
+                self._db.execute("insert or replace into folder values (?, ?, ?)", (account, folder, uidvalidity))
+                self._db.commit()
+
+    def highest(self, account, folder, uidvalidity):
+        """ Returns the highest UID stored for the given folder (or 0).
+        """
+        with self._lock:
+            r = self._db.execute("select max(uid) from message where account=? and folder=? and uidvalidity=?",
+                (account, folder, uidvalidity)).fetchone()
+        return r[0] or 0
+
+    def expunge(self, account, folder, uidvalidity, uids):
+        """ Removes the messages with a UID that is not in the given set of UIDs.
+        """
+        with self._lock:
+            r = self._db.execute("select uid from message where account=? and folder=? and uidvalidity=?",
+                (account, folder, uidvalidity)).fetchall()
+            r = [(account, folder, uidvalidity, uid) for uid, in r if uid not in uids]
+            self._db.executemany("delete from message where account=? and folder=? and uidvalidity=? and uid=?", r)
+            self._db.commit()
+
+    def append(self, account, folder, uidvalidity, uid, message, raw=""):
+        with self._lock:
+            self._db.execute("insert or replace into message values (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                account, folder, uidvalidity, uid,
+                encode_utf8(message.date or ""),
+                encode_utf8(message.author or ""),
+                encode_utf8(message.subject),
+                encode_utf8(message.body),
+                sqlite3.Binary(encode_utf8(raw))))
+            self._db.commit()
+
+    def search(self, account, folder, q, field=FROM):
+        """ Returns a list of Message objects with the given query in the given field, latest-first.
+        """
+        column = {FROM: "sender", DATE: "date", SUBJECT: "subject", BODY: "body"}.get(field, "sender")
+        with self._lock:
+            r = self._db.execute(
+                "select uid, date, sender, subject, body from message " \
+                "where account=? and folder=? and %s like ? order by uid desc" % column,
+                (account, folder, "%%%s%%" % encode_utf8(q))).fetchall()
+        return [Message([
+                (UID, uid),
+               (DATE, decode_utf8(date)),
+               (FROM, decode_utf8(sender)),
+            (SUBJECT, decode_utf8(subject)),
+               (BODY, decode_utf8(body)),
+        (ATTACHMENTS, [])]) for uid, date, sender, subject, body in r]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("select count(*) from message").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
 #--- MAIL MESSAGE ------------------------------------------------------------------------------------
 
 class Message(dict):
@@ -284,6 +648,9 @@ class Message(dict):
     @property
     def attachments(self):
         return self.get(ATTACHMENTS, [])
+    @property
+    def uid(self):
+        return self.get(UID, None)
 
     @property
     def email_address(self):
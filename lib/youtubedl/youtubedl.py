@@ -38,6 +38,7 @@ import socket
 import string
 import subprocess
 import sys
+import threading
 import time
 import urllib
 import urllib2
@@ -4444,6 +4445,97 @@ def gen_extractors():
 		GenericIE()
 	]
 
+class InfoDownloader(FileDownloader):
+	"""Information collector for embedding youtube-dl in another program.
+
+	An InfoDownloader does not print or download anything. Each info
+	dictionary extracted by an InfoExtractor is passed to a callback as soon
+	as it is available, and errors are passed to an error callback instead
+	of being printed. Extractors are created once and reused for every call
+	to extract_info(), so there is no startup cost per query. Callbacks are
+	kept per thread, so the same InfoDownloader can be shared by threads.
+	"""
+
+	def __init__(self, params=None):
+		p = {
+			'quiet': True,
+			'simulate': True,
+			'skip_download': True,
+			'ignoreerrors': True,
+			'outtmpl': u'%(id)s.%(ext)s',
+			'format': None,
+			'format_limit': None,
+			'playliststart': 1,
+			'playlistend': -1,
+		}
+		p.update(params or {})
+		FileDownloader.__init__(self, p)
+		self._local = threading.local()
+		for extractor in gen_extractors():
+			self.add_info_extractor(extractor)
+
+	def to_stderr(self, message):
+		"""Pass the message to the error callback of the current thread."""
+		error = getattr(self._local, 'error', None)
+		if error is not None:
+			error(message)
+
+	def process_info(self, info_dict):
+		"""Pass the info dictionary to the callback of the current thread."""
+		if self._match_entry(info_dict) is not None:
+			return
+		info_dict = dict(info_dict)
+		info_dict['filename'] = self.prepare_filename(info_dict)
+		self._local.callback(info_dict)
+
+	def extract_info(self, url, callback=None, error=None):
+		"""Extract information for the given URL or search query (e.g. ytsearch3:cats).
+
+		Returns the list of info dictionaries. The optional callback is
+		called with each info dictionary as soon as it has been extracted,
+		the optional error callback with each error message.
+		"""
+		results = []
+		def collect(info_dict):
+			results.append(info_dict)
+			if callback is not None:
+				callback(info_dict)
+		self._local.callback = collect
+		self._local.error = error
+		try:
+			for ie in self._ies:
+				if ie.suitable(url):
+					ie.extract(url)
+					break
+			else:
+				self.trouble(u'ERROR: no suitable InfoExtractor: %s' % url)
+		finally:
+			self._local.callback = None
+			self._local.error = None
+		return results
+
+_info_downloader = None
+_info_downloader_lock = threading.Lock()
+
+def extract_info(url, callback=None, error=None):
+	"""Extract information for the given URL or search query with a shared InfoDownloader.
+
+	The first call installs the youtube-dl URL opener (standard headers,
+	cookies, compressed responses) and creates the extractors.
+	See InfoDownloader.extract_info().
+	"""
+	global _info_downloader
+	_info_downloader_lock.acquire()
+	try:
+		if _info_downloader is None:
+			jar = cookielib.CookieJar()
+			opener = urllib2.build_opener(urllib2.ProxyHandler(), urllib2.HTTPCookieProcessor(jar), YoutubeDLHandler())
+			urllib2.install_opener(opener)
+			_info_downloader = InfoDownloader()
+	finally:
+		_info_downloader_lock.release()
+	return _info_downloader.extract_info(url, callback, error)
+
 def _real_main():
 	parser, opts, args = parseOpts()
 
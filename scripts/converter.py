@@ -23,6 +23,11 @@ try:
     from subprocess import Popen,PIPE
     import platform
     import re
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+    import threading
+    import hashlib
+    import json
 except:
     print "ERROR: You need os, subprocess, platform Python Libraries"
 
@@ -34,8 +39,8 @@ except:
 class converter(pyext._class):
     
     # number of inlets and outlets
-    _inlets=4
-    _outlets=2
+    _inlets=5
+    _outlets=3
 
     # methods for all inlets
     outs = []
@@ -46,29 +51,64 @@ class converter(pyext._class):
     out_path = 0
     ratio = 0
     name=0
+    tot_dir = 0
+    workers = 0
 
     # constructor
     def __init__(self,*args):
 	self._detach(1)
         print "Converter object loaded"
+
     def bang_1(self):
-	 checksys = platform.system()
-	 ratio=self.ratio
-	 ffmpeg = "ffmpeg"
-    	 if checksys == "Windows":
-        	ffmpeg = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ffmpeg.exe")
-    	 elif checksys == "Darwin":
-        	ffmpeg = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ffmpeg")
-	 filename = self.in_path
-	 print filename
-	 if file_type(filename):
-	 	self.name= convertfile(filename, self.in_path, self.out_path, ratio, ffmpeg)
-	 	
-
-	 self._outlet(1, self.name)
-	 self._outlet(2, "bang")
+        ffmpeg = ffmpeg_path()
+        if os.path.isdir(self.in_path):
+            self.batch(ffmpeg)
+            return
+        filename = self.in_path
+        print filename
+        if file_type(filename):
+            manifest = Manifest(self.out_path)
+            self.name = output_path(filename, self.in_path, self.out_path)
+            if not manifest.uptodate(filename, self.name, ffmpeg_args(self.ratio)):
+                self.name = convertfile(filename, self.in_path, self.out_path, self.ratio, ffmpeg, manifest)
+        if self.name is None:
+            print 'conversion failed: %s' % filename
+        else:
+            self._outlet(1, self.name)
+        self._outlet(2, "bang")
+
+    def batch(self, ffmpeg):
+        # Converts every video file under in_path with a pool of ffmpeg processes
+        # (one per CPU by default), mirroring the directory tree into out_path.
+        # Files that are still up to date in the manifest of out_path are skipped.
+        files = find_videos(self.in_path)
+        total = len(files)
+        manifest = Manifest(self.out_path)
+        args = ffmpeg_args(self.ratio)
+        files = [f for f in files if not manifest.uptodate(f, output_path(f, self.in_path, self.out_path), args)]
+        if total > len(files):
+            print 'skipped %d up to date files' % (total - len(files))
+        workers = self.workers or multiprocessing.cpu_count()
+        n = total - len(files)
+        self._outlet(3, float(n) / total if total else 1.0)
+        pool = ThreadPool(max(1, min(workers, len(files))))
+        failed = []
+        try:
+            for f, newfile in pool.imap_unordered(lambda f: (f, convertfile(f, self.in_path, self.out_path, self.ratio, ffmpeg, manifest)), files):
+                if newfile is None:
+                    # Failed files are only reported on the console, they don't count as progress.
+                    failed.append(f)
+                    continue
+                n += 1
+                self.name = newfile
+                self._outlet(1, newfile)
+                self._outlet(3, float(n) / total)
+        finally:
+            pool.close()
+        for f in failed:
+            print 'conversion failed: %s' % f
+        self._outlet(2, "bang")
 
-    
     def _anything_2(self,*args):
         self.in_path = os.path.abspath(str(args[0]))
 	for root, subFolders, files in os.walk(self.in_path):
@@ -92,6 +132,10 @@ class converter(pyext._class):
     def _anything_4(self, *args):
 	self.ratio=str(args[0])
 
+    def float_5(self, f):
+        self.workers = max(0, int(f))
+        print 'ffmpeg processes: %s' % (self.workers or multiprocessing.cpu_count())
+
 
 
 
@@ -107,28 +151,134 @@ def file_type(filename):
         return 1
     return 0
 
-#convert the file
-def convertfile(filename, in_path, out_path, ratio, ffmpeg):
-    newfile = os.path.splitext(os.path.basename(in_path))[0]+".mov"
-    newfile2 = os.path.join(out_path, newfile)
-    print 'converting %s -> %s' % (filename, newfile2)
+#return the ffmpeg executable for this platform
+def ffmpeg_path():
+    checksys = platform.system()
+    if checksys == "Windows":
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "ffmpeg.exe")
+    elif checksys == "Darwin":
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "ffmpeg")
+    return "ffmpeg"
+
+#return the list of video files under the given directory
+def find_videos(in_path):
+    files = []
+    for root, subFolders, names in os.walk(in_path):
+        for name in sorted(names):
+            filename = os.path.join(root, name)
+            if file_type(filename):
+                files.append(filename)
+    return files
+
+#return the .mov path for the file, mirroring the directory tree of in_path into out_path
+def output_path(filename, in_path, out_path):
+    newfile = os.path.splitext(os.path.basename(filename))[0]+".mov"
+    if os.path.isdir(in_path):
+        return os.path.normpath(os.path.join(out_path, os.path.relpath(os.path.dirname(filename), in_path), newfile))
+    return os.path.join(out_path, newfile)
+
+#return the ffmpeg arguments used for the given ratio (without input and output file)
+def ffmpeg_args(ratio):
+    args = ["-an", "-sameq", "-vcodec", "mjpeg", "-f", "mov"]
     if ratio:
+        args += ["-s", ratio]
+    return args
+
+#return the md5 hash of the file content
+def file_hash(filename, chunk_size=1048576):
+    h = hashlib.md5()
+    f = open(filename, "rb")
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+#index of converted files, stored as JSON in out_path
+MANIFEST = "converter-manifest.json"
+
+class Manifest:
+
+    def __init__(self, out_path):
+        """ Records source path, size, mtime, content hash and ffmpeg arguments of converted files,
+            so that files that haven't changed since their last conversion can be skipped.
+        """
+        self.path = os.path.join(out_path, MANIFEST)
+        self.entries = {}
+        self._lock = threading.Lock()
         try:
-            p = Popen([ffmpeg, "-i", filename, "-an", "-sameq", "-vcodec", "mjpeg", "-f", "mov", "-y", "-s", ratio, newfile2], stdout=PIPE, stderr=PIPE)
-	    p.wait()
-            if (p.returncode == 1):
-                print "Error on FFMPEG thumb creation"
-        except:
-            print "No FFMPEG library?"
-    else:
-        try:
-            p = Popen([ffmpeg, "-i", filename, "-an", "-sameq", "-vcodec", "mjpeg", "-f", "mov", "-y", newfile2], stdout=PIPE, stderr=PIPE)
-            p.wait()
-	    
-            if (p.returncode == 1):
-                print "Error on FFMPEG thumb creation"
-        except:
-            print "No FFMPEG library?" 
-    return newfile2
+            f = open(self.path, "rb")
+            self.entries = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            pass
+
+    def uptodate(self, filename, newfile, args):
+        """ Returns True if newfile exists and was converted from the same source with the same arguments.
+            The content hash is only computed when the size or the mtime of the source has changed.
+        """
+        e = self.entries.get(os.path.abspath(filename))
+        if e is None or e["args"] != args or e["output"] != newfile or not os.path.exists(newfile):
+            return False
+        st = os.stat(filename)
+        if e["size"] == st.st_size and e["mtime"] == st.st_mtime:
+            return True
+        if e["size"] == st.st_size and e["hash"] == file_hash(filename):
+            # Touched but not modified.
+            self.update(filename, newfile, args, e["hash"])
+            return True
+        return False
 
+    def update(self, filename, newfile, args, hash=None):
+        st = os.stat(filename)
+        e = {
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "hash": hash or file_hash(filename),
+            "args": args,
+            "output": newfile
+        }
+        with self._lock:
+            self.entries[os.path.abspath(filename)] = e
+            self.save()
 
+    def save(self):
+        # Write to a temporary file first, so an interrupted save doesn't lose the manifest.
+        tmp = self.path + ".tmp"
+        f = open(tmp, "wb")
+        json.dump(self.entries, f, indent=1)
+        f.close()
+        if os.path.exists(self.path) and platform.system() == "Windows":
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+#convert the file
+def convertfile(filename, in_path, out_path, ratio, ffmpeg, manifest=None):
+    newfile2 = output_path(filename, in_path, out_path)
+    if not os.path.isdir(os.path.dirname(newfile2)):
+        try:
+            os.makedirs(os.path.dirname(newfile2))
+        except OSError:
+            pass # created by another worker
+    print 'converting %s -> %s' % (filename, newfile2)
+    command = [ffmpeg, "-i", filename] + ffmpeg_args(ratio) + ["-y", newfile2]
+    # Returns None if ffmpeg fails (or can't be started).
+    try:
+        p = Popen(command, stdout=PIPE, stderr=PIPE)
+        # communicate() instead of wait(): ffmpeg output would fill the pipe and block.
+        p.communicate()
+    except:
+        print "No FFMPEG library?"
+        return None
+    if p.returncode != 0:
+        print "Error on FFMPEG conversion of %s (exit code %d)" % (filename, p.returncode)
+        if os.path.exists(newfile2):
+            os.remove(newfile2) # incomplete output
+        return None
+    if manifest is not None:
+        manifest.update(filename, newfile2, ffmpeg_args(ratio))
+    return newfile2
@@ -25,19 +25,24 @@ except:
 	print "ERROR: can't load some libraries"
 
 try:
-	from pattern.web import Flickr, extension, plaintext, encode_utf8
+	from pattern.web import Flickr, URL, WorkerPool, extension, plaintext, encode_utf8
 except:
 	print "I'm loading pattern module from lib directory"
         MODULE_PATTERN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib/pattern")
         sys.path.append(MODULE_PATTERN)
         try:
-	    from pattern.web import Flickr, extension, plaintext, encode_utf8
+	    from pattern.web import Flickr, URL, WorkerPool, extension, plaintext, encode_utf8
         except:
 	    print "ERROR: can't load pattern library"
 
 from Tkinter import *
 import random
 
+# Photo URLs are resolved (one API call each) and images are downloaded
+# on a bounded pool of threads shared by all flickr objects.
+FETCH_THREADS = 8
+fetchers = WorkerPool(threads=FETCH_THREADS)
+
 
 class start(pyext._class):
 
@@ -92,27 +97,39 @@ class start(pyext._class):
                 output = "%s%s" % ("created: ", str(pathdir))
                 self._outlet(5, output)
 
-        for img in results:
-            author = encode_utf8(plaintext(img.author))
-	    description = encode_utf8(img.description)
-            url = encode_utf8(img.url)
-            self._outlet(1, description)
-            self._outlet(2, author)
-            self._outlet(3, url)
-            if (download):
-                if url != "None":
-                    data = img.download()
-                    filename = img.url.rsplit("/",1)[1]
-                    pathfile = os.path.join(pathdir, filename)
-                    f = open(pathfile, "w")
-                    f.write(data)
-                    f.close()
-                    output = "%s%s" % ("downloaded: ", str(pathfile))
-                    self._outlet(5, output)
+        else:
+            pathdir = None
+
+        jobs = [fetchers.submit(self.fetch, img, pathdir) for img in results]
+        for job in jobs:
+            job.now()
 
         if (download):
             self._outlet(4, str(pathdir))
 
+    def fetch(self, img, pathdir=None):
+        # Resolves the photo URL and (if pathdir is given) downloads the image.
+        # Runs in the fetchers pool, results are sent as soon as each image is ready.
+        try:
+            author = encode_utf8(plaintext(img.author))
+            description = encode_utf8(img.description)
+            url = img.url
+            if url and pathdir is not None:
+                filename = url.rsplit("/",1)[1]
+                pathfile = os.path.join(pathdir, filename)
+                # The image is streamed to the file in chunks.
+                URL(url).save(pathfile)
+            url = encode_utf8(url)
+        except Exception, e:
+            self._outlet(5, "%s%s" % ("error: ", repr(e)))
+            return
+        self._outlet(1, description)
+        self._outlet(2, author)
+        self._outlet(3, url)
+        if url != "None" and pathdir is not None:
+            output = "%s%s" % ("downloaded: ", str(pathfile))
+            self._outlet(5, output)
+
     def float_2(self,f):
         self.start = int(f)
         output = "%s%d" % ("start: ", self.start)
@@ -25,13 +25,13 @@ except:
 	print "ERROR: can't load some libraries"
 
 try:
-	from pattern.web import Mail, plaintext, encode_utf8
+	from pattern.web import Mail, MailStore, plaintext, encode_utf8
 except:
 	print "I'm loading pattern module from lib directory"
         MODULE_PATTERN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib/pattern")
         sys.path.append(MODULE_PATTERN)
         try:
-	    from pattern.web import Mail, plaintext, encode_utf8
+	    from pattern.web import Mail, MailStore, plaintext, encode_utf8
         except:
 	    print "ERROR: can't load pattern library"
 
@@ -71,15 +71,33 @@ class start(pyext._class):
 
         if hasattr(self, 'username') and hasattr(self, 'passw'):
             self.input = str(args[0])
-            mail = Mail(self.username, self.passw, service=varservice, port=varport)
+            mail = self.session(varservice, varport)
             if self.input == "search":
-                mailres = getattr(mail,varfolder).search(varquery, field=varfield)
-                for amail in mailres[:howmany]:
-                    m = getattr(mail,varfolder).read(amail)
-                    self._outlet(2, encode_utf8(plaintext(m.author)))
-                    self._outlet(3, encode_utf8(plaintext(m.subject)))
-                    self._outlet(4, encode_utf8(plaintext(m.body)))
-                    self._outlet(5, m.attachments)
+                folder = getattr(mail,varfolder)
+                if varfolder in self.synced:
+                    # Synced folders are searched in the local store, without contacting the server.
+                    # New messages are added to the store with the next sync.
+                    for m in folder.find(varquery, field=varfield)[:howmany]:
+                        self.send(m)
+                else:
+                    mailres = folder.search(varquery, field=varfield)
+                    # All messages are retrieved with a single FETCH command.
+                    for m in folder.fetch(mailres[:howmany]):
+                        self.send(m)
+            elif self.input == "sync":
+                # sync: copy the folder to the local store, later searches don't need the server.
+                n = getattr(mail,varfolder).sync()
+                self.synced.add(varfolder)
+                self._outlet(6, "%s%s%s%s" % ("synced: ", varfolder, " new: ", n))
+            elif self.input == "watch":
+                # watch [body]: new messages are pushed by the server (IMAP IDLE).
+                self.unwatch()
+                body = len(args) > 1 and str(args[1]) == "body"
+                self.watcher = getattr(mail,varfolder).watch(self.send, body=body)
+                self._outlet(6, "%s%s" % ("watching: ", varfolder))
+            elif self.input == "unwatch":
+                self.unwatch()
+                self._outlet(6, "stopped watching")
             elif self.input == "getf":
                 print mail.folders
                 for folder in mail.folders.keys():
@@ -87,6 +105,31 @@ class start(pyext._class):
         else:
             self._outlet(6, "you need to insert username and password inlets")
 
+    def send(self, m):
+        self._outlet(2, encode_utf8(plaintext(m.author)))
+        self._outlet(3, encode_utf8(plaintext(m.subject)))
+        self._outlet(4, encode_utf8(plaintext(m.body)))
+        self._outlet(5, m.attachments)
+
+    def unwatch(self):
+        if getattr(self, 'watcher', None) is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def session(self, service, port):
+        # The logged-in connection is kept across bangs.
+        # A new connection is opened when the account changes or when the server dropped it.
+        key = (self.username, self.passw, service, port)
+        if getattr(self, 'mail', None) is None or self.mailkey != key:
+            if getattr(self, 'store', None) is None:
+                self.store = MailStore()
+            self.mail = Mail(self.username, self.passw, service=service, port=port, store=self.store)
+            self.mailkey = key
+            self.synced = set()
+        elif not self.mail.alive:
+            self.mail.reconnect()
+        return self.mail
+
     def _anything_2(self,*args):
         self.username = str(args[0])
         output = "%s%s" % ("username: ", self.username)
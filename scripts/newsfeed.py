@@ -20,7 +20,7 @@ except:
 	print "ERROR: This script must be loaded by the PD/Max pyext external"
 
 try:
-	import os, sys
+	import os, sys, threading
 except:
 	print "ERROR: can't load some libraries"
 
@@ -39,12 +39,14 @@ except:
 class start(pyext._class):
 
     # number of inlets and outlets
-    _inlets=2
+    _inlets=3
     _outlets=3
 
     # constructor
     def __init__(self,*args):
         self._detach(1)
+        self.feed = Newsfeed()
+        self.poller = None
         print "newsfeed object loaded"
 
     def _anything_1(self,*args):
@@ -52,13 +54,58 @@ class start(pyext._class):
         howmany=10
         if hasattr(self, 'howmany'):
             howmany = self.howmany
-        dbgmsg = "%s%d%s%s" % ("getting ", self.howmany, " results from feed ", self.input)
+        dbgmsg = "%s%d%s%s" % ("getting ", howmany, " results from feed ", self.input)
         self._outlet(3, dbgmsg)
-        for result in Newsfeed().search(self.input)[:howmany]:
-            self._outlet(1, repr(result.title))
-            self._outlet(2, repr(result.description))
+        if self.poller is not None:
+            # In polling mode only the new entries are sent (the first poll sends them all).
+            self.poller.url = self.input
+            self.poller.wake.set()
+            return
+        for result in self.feed.search(self.input)[:howmany]:
+            self.send(result)
+
+    def send(self, result):
+        self._outlet(1, repr(result.title))
+        self._outlet(2, repr(result.description))
+
+    def poll(self, poller):
+        # Runs in its own thread until the interval is set to 0.
+        while not poller.stopped:
+            if poller.url:
+                try:
+                    for result in self.feed.poll(poller.url):
+                        self.send(result)
+                except Exception, e:
+                    self._outlet(3, "%s%s" % ("error: ", e))
+            poller.wake.wait(poller.interval)
+            poller.wake.clear()
 
     def float_2(self,f):
         self.howmany = int(f)
         output = "%s%d" % ("how many: ", self.howmany)
         self._outlet(3, output)
+
+    def float_3(self,f):
+        # Poll interval in seconds, 0 stops polling.
+        if f > 0 and self.poller is None:
+            self.poller = Poller(getattr(self, 'input', None), f)
+            self.poller.thread = threading.Thread(target=self.poll, args=(self.poller,))
+            self.poller.thread.daemon = True
+            self.poller.thread.start()
+        elif f > 0:
+            self.poller.interval = f
+        elif self.poller is not None:
+            self.poller.stopped = True
+            self.poller.wake.set()
+            self.poller = None
+        output = "%s%s" % ("poll interval: ", f)
+        self._outlet(3, output)
+
+
+class Poller:
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.interval = interval
+        self.stopped = False
+        self.wake = threading.Event()
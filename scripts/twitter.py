@@ -25,14 +25,14 @@ except:
 	print "ERROR: can't load some libraries"
 
 try:
-	from pattern.web import Twitter, plaintext, encode_utf8
+	from pattern.web import Twitter, plaintext, encode_utf8, workers
 
 except:
 	print "I'm loading pattern module from lib directory"
         MODULE_PATTERN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib/pattern")
         sys.path.append(MODULE_PATTERN)
         try:
-	    from pattern.web import Twitter, plaintext, encode_utf8
+	    from pattern.web import Twitter, plaintext, encode_utf8, workers
         except:
 	    print "ERROR: can't load pattern library"
 
@@ -60,10 +60,21 @@ class start(pyext._class):
             howmany = self.howmany
         dbgmsg = "%s%d%s%s" % ("getting ", self.howmany, " results about: ", self.input)
         self._outlet(4, dbgmsg)
-        for tweet in Twitter().search(self.input, cached=False)[:howmany]:
+        # The search runs on the shared worker pool so that a slow response
+        # doesn't block this object (or other twitter objects).
+        # Identical queries from this object are coalesced while pending.
+        workers.submit(self.search, self.input, howmany, key=(id(self), self.input, howmany))
+
+    def search(self, query, howmany):
+        try:
+            results = Twitter().search(query, cached=False)[:howmany]
+        except Exception, e:
+            self._outlet(4, "%s%s" % ("error: ", repr(e)))
+            return
+        for tweet in results:
             author = encode_utf8(plaintext(tweet.author))
             date = encode_utf8(plaintext(tweet.date))
-	    description = encode_utf8(plaintext(tweet.description))    
+            description = encode_utf8(plaintext(tweet.description))
             self._outlet(1, description)
             self._outlet(2, author)
             self._outlet(3, date)
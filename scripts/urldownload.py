@@ -20,29 +20,396 @@ except:
 	print "ERROR: This script must be loaded by the PD/Max pyext external"
 
 try:
-	import os, sys, urllib2, tempfile
+	import os, sys, urllib2, urlparse, tempfile, threading, json, re
 except:
 	print "ERROR: can't load some libraries"
 
 
+#### DOWNLOAD ENGINE ###################################################################################
+# Large files are split into byte ranges that are fetched on concurrent connections
+# and written into a preallocated file. Progress is stored in a [filename].part file
+# so that an interrupted download can be resumed. Single streams are written to a [filename].tmp file
+# that is renamed when complete. A finished download records its URL in a [filename].url file.
+
+SEGMENTS = 4
+CHUNK_SIZE = 65536
+MIN_SEGMENT_SIZE = 1048576 # Files smaller than 1MB are downloaded in a single stream.
+STATE_INTERVAL = 4194304   # Save the .part file every 4MB.
+
+RE_CONTENT_RANGE = re.compile(r"bytes\s+\d+-\d+/(\d+)")
+
+class DownloadError(Exception):
+    pass
+class DownloadCancelled(DownloadError):
+    pass
+
+def probe(url, timeout=10):
+    """ Returns a (size, ranges)-tuple for the given URL.
+        The size is None when the server omits Content-Length.
+        Ranges is True when the server accepts byte range requests.
+    """
+    request = urllib2.Request(url, headers={"Range": "bytes=0-0"})
+    response = urllib2.urlopen(request, timeout=timeout)
+    info = response.info()
+    size = None
+    ranges = False
+    m = RE_CONTENT_RANGE.match(info.getheader("Content-Range") or "")
+    if response.getcode() == 206 and m:
+        size = int(m.group(1))
+        ranges = True
+    elif info.getheader("Content-Length"):
+        size = int(info.getheader("Content-Length").strip())
+        ranges = (info.getheader("Accept-Ranges") or "").strip().lower() == "bytes"
+    response.close()
+    return size, ranges
+
+class Download:
+
+    def __init__(self, url, filename, segments=SEGMENTS, progress=None, timeout=10):
+        """ Downloads the given URL to the given file.
+            With a known size and byte range support, the file is split into segments
+            that are fetched concurrently. Otherwise, it is downloaded in a single stream.
+            The optional progress function is called with (bytes_so_far, total_size);
+            total_size is None when the size is unknown.
+        """
+        self.url = url
+        self.filename = filename
+        self.segments = max(1, int(segments))
+        self.timeout = timeout
+        self._progress = progress
+        self._lock = threading.Lock()
+        self._state = None
+        self._saved = 0
+        self._errors = []
+        self._cancelled = False
+
+    def cancel(self):
+        """ Stops the download (from another thread).
+            A segmented download keeps its .part file and can be resumed later.
+        """
+        self._cancelled = True
+
+    @property
+    def statefile(self):
+        return self.filename + ".part"
+
+    @property
+    def tempfile(self):
+        return self.filename + ".tmp"
+
+    @property
+    def urlfile(self):
+        return self.filename + ".url"
+
+    def start(self):
+        """ Downloads the file and returns its filename (blocking).
+        """
+        size, ranges = probe(self.url, self.timeout)
+        # The file is about to be overwritten, it no longer belongs to a finished download.
+        if os.path.exists(self.urlfile):
+            os.remove(self.urlfile)
+        if size and ranges:
+            self._segmented(size)
+        else:
+            self._stream(size)
+        f = open(self.urlfile, "wb")
+        f.write(self.url)
+        f.close()
+        return self.filename
+
+    def _stream(self, size):
+        # Single stream: no resume, size can be unknown.
+        response = urllib2.urlopen(self.url, timeout=self.timeout)
+        bytes_so_far = 0
+        f = open(self.tempfile, "wb")
+        try:
+            try:
+                while not self._cancelled:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    bytes_so_far += len(chunk)
+                    self.progress(bytes_so_far, size)
+            finally:
+                f.close()
+                response.close()
+            if self._cancelled:
+                raise DownloadCancelled(self.url)
+        except:
+            os.remove(self.tempfile)
+            raise
+        if os.path.exists(self.filename):
+            os.remove(self.filename) # os.rename() does not overwrite on Windows.
+        os.rename(self.tempfile, self.filename)
+
+    def _load_state(self, size):
+        # Resume from the [filename].part file if it matches the current download.
+        try:
+            f = open(self.statefile, "rb")
+            state = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return None
+        if state.get("url") != self.url \
+        or state.get("size") != size \
+        or not os.path.exists(self.filename) \
+        or os.path.getsize(self.filename) != size:
+            return None
+        return state
+
+    def _save_state(self):
+        f = open(self.statefile, "wb")
+        json.dump(self._state, f)
+        f.close()
+
+    def _segmented(self, size):
+        self._state = self._load_state(size)
+        if self._state is None:
+            n = max(1, min(self.segments, size // MIN_SEGMENT_SIZE))
+            k = size // n
+            # Each segment is a [start, stop, written]-list (stop is inclusive).
+            segments = [[i*k, (i == n-1) and size-1 or (i+1)*k-1, 0] for i in range(n)]
+            self._state = {"url": self.url, "size": size, "segments": segments}
+            # Preallocate the file.
+            f = open(self.filename, "wb")
+            f.truncate(size)
+            f.close()
+            self._save_state()
+        self._errors = []
+        threads = []
+        for segment in self._state["segments"]:
+            if segment[0] + segment[2] <= segment[1]:
+                t = threading.Thread(target=self._fetch, args=(segment,))
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+        if self._errors:
+            # Keep the .part file so the download can be resumed.
+            self._save_state()
+            raise self._errors[0]
+        os.remove(self.statefile)
+
+    def _fetch(self, segment):
+        try:
+            start, stop = segment[0] + segment[2], segment[1]
+            request = urllib2.Request(self.url, headers={"Range": "bytes=%d-%d" % (start, stop)})
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            if response.getcode() != 206:
+                raise DownloadError("server ignored byte range request")
+            f = open(self.filename, "r+b", 0) # Unbuffered, the .part file must not run ahead.
+            f.seek(start)
+            try:
+                while start <= stop and not self._cancelled:
+                    chunk = response.read(min(CHUNK_SIZE, stop-start+1))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    start += len(chunk)
+                    with self._lock:
+                        segment[2] += len(chunk)
+                        bytes_so_far = self.bytes_so_far
+                        if bytes_so_far - self._saved >= STATE_INTERVAL:
+                            self._save_state()
+                            self._saved = bytes_so_far
+                        self.progress(bytes_so_far, self._state["size"])
+            finally:
+                f.close()
+                response.close()
+            if self._cancelled:
+                raise DownloadCancelled(self.url)
+            if start <= stop:
+                raise DownloadError("connection closed at byte %d" % start)
+        except Exception, e:
+            with self._lock:
+                self._errors.append(e)
+
+    @property
+    def bytes_so_far(self):
+        return sum(segment[2] for segment in self._state["segments"])
+
+    def progress(self, bytes_so_far, total_size):
+        if self._progress is not None:
+            self._progress(bytes_so_far, total_size)
+
+def downloaded(url, filename):
+    """ Returns True if the given file is a finished download of the given URL.
+    """
+    if not os.path.exists(filename) or os.path.exists(filename + ".part"):
+        return False
+    try:
+        f = open(filename + ".url", "rb")
+        s = f.read()
+        f.close()
+    except IOError:
+        return False
+    return s == url
+
+#### DOWNLOAD QUEUE ####################################################################################
+# Downloads are queued and started in order of priority (first-come first-served for equal priority),
+# with a maximum number of concurrent downloads and a maximum number of connections per host.
+
+CONCURRENT = 2
+PER_HOST = 4
+
+class QueueItem:
+
+    def __init__(self, url, filename, priority=0, segments=SEGMENTS):
+        self.url = url
+        self.filename = filename
+        self.priority = priority
+        self.segments = segments
+        self.host = urlparse.urlsplit(url)[1].lower()
+        self.download = None
+        self.bytes_so_far = 0
+        self.total_size = None
+
+    def __repr__(self):
+        return "QueueItem(url=%s, priority=%s)" % (repr(self.url), self.priority)
+
+class DownloadQueue:
+
+    def __init__(self, concurrent=CONCURRENT, per_host=PER_HOST, done=None, error=None, progress=None, changed=None):
+        """ A queue of downloads that runs at most the given number of downloads concurrently,
+            using at most per_host connections to the same host.
+            Identical URLs already queued (or running) are ignored.
+            The optional callbacks are called with:
+            - done(item), error(item, exception): when a download finishes,
+            - progress(bytes_so_far, total_size): combined progress of running downloads,
+            - changed(queued, running): when the queue depth changes.
+        """
+        self.concurrent = concurrent
+        self.per_host = per_host
+        self._done = done
+        self._error = error
+        self._progress = progress
+        self._changed = changed
+        self._queued = []
+        self._running = []
+        self._lock = threading.RLock()
+        self._count = 0
+
+    def _get(self, url):
+        for item in self._queued + self._running:
+            if item.url == url:
+                return item
+
+    def push(self, url, filename, priority=0, segments=SEGMENTS):
+        """ Queues the download and returns its QueueItem, or None if the URL is already queued.
+        """
+        with self._lock:
+            if self._get(url) is not None:
+                return None
+            item = QueueItem(url, filename, priority, segments)
+            item.index = self._count
+            self._count += 1
+            self._queued.append(item)
+            self._schedule()
+        return item
+
+    def bump(self, url, priority):
+        """ Changes the priority of the queued download with the given URL.
+        """
+        with self._lock:
+            item = self._get(url)
+            if item is None:
+                return False
+            item.priority = priority
+            self._schedule()
+        return True
+
+    def cancel(self, url):
+        """ Removes the download with the given URL from the queue, or stops it if it is running.
+        """
+        with self._lock:
+            item = self._get(url)
+            if item is None:
+                return False
+            if item in self._queued:
+                self._queued.remove(item)
+                self._update()
+            elif item.download is not None:
+                item.download.cancel()
+        return True
+
+    def _connections(self, host):
+        return sum(item.segments for item in self._running if item.host == host)
+
+    def _schedule(self):
+        # Start the queued downloads with the highest priority, as long as there are free slots.
+        self._queued.sort(key=lambda item: (-item.priority, item.index))
+        for item in list(self._queued):
+            if len(self._running) >= self.concurrent:
+                break
+            item.segments = max(1, min(item.segments, self.per_host))
+            if self._connections(item.host) + item.segments > self.per_host:
+                continue
+            self._queued.remove(item)
+            self._running.append(item)
+            t = threading.Thread(target=self._run, args=(item,))
+            t.daemon = True
+            t.start()
+        self._update()
+
+    def _run(self, item):
+        def progress(bytes_so_far, total_size):
+            item.bytes_so_far = bytes_so_far
+            item.total_size = total_size
+            self.progress()
+        item.download = Download(item.url, item.filename, item.segments, progress=progress)
+        error = None
+        try:
+            item.download.start()
+        except Exception, e:
+            error = e
+        with self._lock:
+            self._running.remove(item)
+            self._schedule()
+        if error is None and self._done is not None:
+            self._done(item)
+        if error is not None and self._error is not None:
+            self._error(item, error)
+
+    def _update(self):
+        if self._changed is not None:
+            self._changed(len(self._queued), len(self._running))
+
+    def progress(self):
+        if self._progress is not None:
+            with self._lock:
+                bytes_so_far = sum(item.bytes_so_far for item in self._running)
+                total_size = sum(item.total_size or 0 for item in self._running)
+                if not all(item.total_size for item in self._running):
+                    total_size = None # Unknown size.
+            self._progress(bytes_so_far, total_size)
+
+    def __len__(self):
+        return len(self._queued) + len(self._running)
+
+    def __contains__(self, url):
+        with self._lock:
+            return self._get(url) is not None
+
+#### PYEXT ###########################################################################################
+
 class start(pyext._class):
 
     # number of inlets and outlets
-    _inlets=3
-    _outlets=3
+    _inlets=6
+    _outlets=4
 
     # constructor
     def __init__(self,*args):
         self._detach(1)
+        self.queue = DownloadQueue(done=self.done, error=self.error, progress=self.progress, changed=self.changed)
         print "urldownload object loaded"
 
     def _anything_1(self,*args):
+        # url [priority]
         self.input = str(args[0])
-        chunk_size = 8192
-        response = urllib2.urlopen(self.input);
-        total_size = response.info().getheader('Content-Length').strip()
-        total_size = int(total_size)
-        bytes_so_far = 0
+        priority = len(args) > 1 and int(args[1]) or 0
+        segments = SEGMENTS
 
         if hasattr(self, 'filename'):
             filename = self.filename
@@ -53,23 +420,30 @@ class start(pyext._class):
             filename = os.path.join(os.path.abspath(self.path), filename)
         else:
             filename = os.path.join(tempfile.gettempdir(), filename)
-       
-        f = open(filename, 'wb')
 
-        while 1:
-           chunk = response.read(chunk_size)
-   
-           f.write(chunk)
+        if hasattr(self, 'segments'):
+            segments = self.segments
 
-           bytes_so_far += len(chunk)
-    
-           if not chunk:
-              break
-    
-           self.progress(bytes_so_far, chunk_size, total_size)
+        # Skip URLs that are queued, or that have already been downloaded completely to this file.
+        if self.input in self.queue:
+            self._outlet(3, "%s%s" % ("already queued: ", self.input))
+            return
+        if downloaded(self.input, filename):
+            self._outlet(3, "%s%s" % ("already downloaded: ", filename))
+            self._outlet(1, filename)
+            return
+        if self.queue.push(self.input, filename, priority, segments) is None:
+            self._outlet(3, "%s%s" % ("already queued: ", self.input))
 
-        f.close()
-        self._outlet(1, filename)
+    def priority_1(self,*args):
+        # priority url n
+        if self.queue.bump(str(args[0]), int(args[1])):
+            self._outlet(3, "%s%s %d" % ("priority: ", args[0], int(args[1])))
+
+    def cancel_1(self,*args):
+        # cancel url
+        if self.queue.cancel(str(args[0])):
+            self._outlet(3, "%s%s" % ("cancelled: ", args[0]))
 
     def _anything_2(self,*args):
         self.filename = str(args[0])
@@ -81,12 +455,38 @@ class start(pyext._class):
         output = "%s%s" % ("path: ", self.path)
         self._outlet(3, output)
 
-    def progress(self, bytes_so_far, chunk_size, total_size):
+    def float_4(self,f):
+        self.segments = max(1, int(f))
+        output = "%s%d" % ("segments: ", self.segments)
+        self._outlet(3, output)
+
+    def float_5(self,f):
+        self.queue.concurrent = max(1, int(f))
+        output = "%s%d" % ("concurrent downloads: ", self.queue.concurrent)
+        self._outlet(3, output)
+
+    def float_6(self,f):
+        self.queue.per_host = max(1, int(f))
+        output = "%s%d" % ("connections per host: ", self.queue.per_host)
+        self._outlet(3, output)
+
+    def done(self, item):
+        self._outlet(3, "%s%s" % ("DONE ", item.url))
+        self._outlet(1, item.filename)
+
+    def error(self, item, e):
+        self._outlet(3, "%s%s: %s" % ("error: ", item.url, str(e)))
+
+    def changed(self, queued, running):
+        self._outlet(4, queued + running)
+
+    def progress(self, bytes_so_far, total_size):
+        if not total_size:
+            output = "Downloaded %d bytes" % bytes_so_far
+            self._outlet(3, output)
+            return
         progr_float = float(bytes_so_far) / total_size
         self._outlet(2, progr_float)
         percent = round(progr_float*100, 2)
         output = "Downloaded %d of %d bytes (%0.2f%%)" % (bytes_so_far, total_size, percent)
         self._outlet(3, output)
-
-        if bytes_so_far >= total_size:
-           self._outlet(3, "DONE")
@@ -20,24 +20,57 @@ except:
 	print "ERROR: This script must be loaded by the PD/Max pyext external"
 
 try:
-	import os, re, sys, platform, subprocess
+	import os, re, sys, time, json
 except:
 	print "ERROR: can't load some libraries"
 
-#MODULE_YOUTUBE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib/youtubedl")
-#sys.path.append(MODULE_YOUTUBE)
-#try:
-#        import youtubedl as youtubedl
-#except:
-#	print "ERROR: can't load youtubedl library"
+try:
+        import youtubedl
+except:
+        MODULE_YOUTUBE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib/youtubedl")
+        sys.path.append(MODULE_YOUTUBE)
+        try:
+            import youtubedl
+        except:
+	    print "ERROR: can't load youtubedl library"
+
+try:
+	from pattern.web import cache, WorkerPool
+except:
+	print "I'm loading pattern module from lib directory"
+        MODULE_PATTERN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib/pattern")
+        sys.path.append(MODULE_PATTERN)
+        try:
+	    from pattern.web import cache, WorkerPool
+        except:
+	    print "ERROR: can't load pattern library"
+
+# The info fields sent to outlets 1-6 for each result.
+FIELDS = ("title", "url", "thumbnail", "description", "filename", "format")
+
+# Search results are stored in the pattern.web cache (so Cache.clear() also clears them),
+# keyed by (provider, count, query), for TTL seconds.
+TTL = 3600
+
+def cache_id(provider, count, query):
+    return "videosearch-%s-%d-%s" % (provider, count, query)
+
+# Background refreshes and prewarm searches run on a pool of threads shared by all videosearch objects.
+# youtube-dl searches take seconds, so they don't go on the pattern.web workers pool used by other objects.
+SEARCH_THREADS = 2
+searchers = WorkerPool(threads=SEARCH_THREADS)
 
 
 class start(pyext._class):
 
     # number of inlets and outlets
-    _inlets=3
+    _inlets=5
     _outlets=7
 
+    # cache settings
+    ttl = TTL
+    stale = False
+
     # constructor
     def __init__(self,*args):
         self._detach(1)
@@ -56,39 +89,69 @@ class start(pyext._class):
         for arg in args:
             tosearch.append(str(arg))
         self.input = ' '.join(tosearch)
-        searchstring = "%s%d%s%s%s" % (provider, howmany, ":\"", self.input, "\"")
 
-        youtubedl = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib/youtubedl/youtubedl.py")
-        myos = platform.system()
-        commandln = ["python", youtubedl, "-s", "--get-title", "--get-description", "--get-filename", "--get-format", "--get-thumbnail", "--get-url", searchstring]
+        id = cache_id(provider, howmany, self.input)
+        entry = self.cached(id)
+        if entry is not None:
+            age = time.time() - entry["time"]
+            if age < self.ttl or self.stale:
+                for info in entry["results"]:
+                    self.send(info)
+                if age >= self.ttl:
+                    # Serve stale results now, refresh them in the background.
+                    searchers.submit(self.search, provider, howmany, self.input, key=id)
+                return
+        self.search(provider, howmany, self.input, callback=self.send)
+
+    def prewarm_1(self,*args):
+        # prewarm query1 query2 ...: fill the cache before a show.
+        howmany = 3
+        provider = "ytsearch"
+        if hasattr(self, 'provider'):
+            provider = self.provider
+        if hasattr(self, 'count'):
+            howmany = self.count
+        jobs = []
+        for arg in args:
+            query = str(arg)
+            id = cache_id(provider, howmany, query)
+            entry = self.cached(id)
+            if entry is None or time.time() - entry["time"] >= self.ttl:
+                jobs.append(searchers.submit(self.search, provider, howmany, query, key=id))
+        for job in jobs:
+            job.now()
+        self._outlet(7, "%s%d" % ("prewarmed: ", len(jobs)))
+
+    def cached(self, id):
         try:
-                startupinfo = None
-                if myos == "Windows":
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                p = subprocess.Popen(commandln, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                p.wait()
-                if (p.returncode == 1):
-                    for errline in p.stderr:
-                        self._outlet(7,errline)
-                        break
-                else:
-                    inletcount = 0
-                    while True:
-                        line = p.stdout.readline()
-                        if line != '':
-                            if inletcount < 6:
-                                inletcount = inletcount +1
-                            else:
-                                inletcount = 1
-                            self._outlet(inletcount,line.rstrip())
-                        else:
-                            break
-                    for boh in p.stderr:
-                        self._outlet(7,boh)
-                        break
-        except:
-                self._outlet(7,"No youtubedl installed?")
+            return json.loads(cache[id])
+        except (KeyError, ValueError):
+            return None
+
+    def search(self, provider, howmany, query, callback=None):
+        # Extraction runs in this interpreter with extractors that are created once,
+        # and each result is sent as soon as it has been extracted.
+        searchstring = "%s%d%s%s%s" % (provider, howmany, ":\"", query, "\"")
+        try:
+            results = youtubedl.extract_info(searchstring, callback=callback, error=self.error)
+        except Exception, e:
+            self._outlet(7, "%s%s" % ("error: ", str(e)))
+            return
+        if results:
+            results = [dict((field, info.get(field) or "") for field in FIELDS) for info in results]
+            cache[cache_id(provider, howmany, query)] = json.dumps({"time": time.time(), "results": results})
+
+    def send(self, info):
+        for i, field in enumerate(FIELDS):
+            value = info.get(field) or ""
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            self._outlet(i+1, str(value).rstrip())
+
+    def error(self, message):
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+        self._outlet(7, message)
 
     def float_2(self,f):
         self.count = int(f)
@@ -105,3 +168,13 @@ class start(pyext._class):
             self.provider = 'ybsearch'
         output = "%s%s" % ("provider: ", self.provider)
         self._outlet(7, output)
+
+    def float_4(self,f):
+        self.ttl = max(0, int(f))
+        output = "%s%d" % ("cache ttl: ", self.ttl)
+        self._outlet(7, output)
+
+    def float_5(self,f):
+        self.stale = int(f) != 0
+        output = "%s%s" % ("serve stale: ", self.stale)
+        self._outlet(7, output)